@@ -1,19 +1,42 @@
+import importlib
 import io
 import logging
 import mimetypes
-import os
-import tempfile
+from typing import BinaryIO, Iterator
+from urllib.parse import urlparse
 
-import mammoth
 import requests
-from pdfminer.high_level import extract_text_to_fp
 
-from .html import md_from_html
-from .image import extract_image_md
-from .powerpoint import extract_pptx_md
+from .batch import extract_many
+from .cache import DiskCache, HttpCache, ResultCache
+from .download import DownloadTooLargeError, MAX_DOWNLOAD_BYTES, get_session, max_bytes_for, set_session, \
+    stream_to_file
+from .registry import get_handler, get_page_handler, preload_handlers, register_handler, register_page_handler
+from .sniff import resolve_mimetype, sniff_mimetype
+
+# Re-exported from the handler modules, which are only imported when first used, see __getattr__
+_LAZY_EXPORTS = {
+    'md_from_html': 'html',
+    'iter_md_from_html': 'html',
+    'set_html_parser': 'html',
+    'extract_image_md': 'image',
+    'set_ocr_executor': 'image',
+    'init_ocr_worker': 'image',
+    'set_ocr_engine': 'image',
+    'extract_pptx_md': 'powerpoint',
+    'aextract_from_url': 'aio',
+}
 
 logger = logging.getLogger(__name__)
 
+
+def __getattr__(name: str):
+    if name in _LAZY_EXPORTS:
+        module = importlib.import_module(f'.{_LAZY_EXPORTS[name]}', __name__)
+        return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 def _normalize_mime_type(filemime: str) -> str:
     """Strip parameters (such as charset) from a MIME type string."""
     if not filemime:
@@ -22,7 +45,8 @@ def _normalize_mime_type(filemime: str) -> str:
 
 
 def extract_from_url(url: str, extract_images: bool = True, strip_non_content: bool = True,
-                     enhance_images: bool = True) -> str:
+                     enhance_images: bool = True, max_bytes: dict | int = None,
+                     session: requests.Session = None, cache: HttpCache = None, **options) -> str:
     """
     Extract text from a URL
     :param url:
@@ -30,27 +54,94 @@ def extract_from_url(url: str, extract_images: bool = True, strip_non_content: b
     :param extract_images:
     :param strip_non_content:
     :param enhance_images:
+    :param max_bytes: Maximum download size, a single cap or a mapping per content type like
+      download.MAX_DOWNLOAD_BYTES
+    :param session: The requests session for the document and its images, defaults to the shared pooled session
+    :param cache: Optionally a cache of earlier results for this URL. If the server says the document hasn't changed
+      since (304 Not Modified) the cached markdown is returned without downloading or extracting it again.
+    :param options: Passed through to the handler for the document's mimetype
+    :raises DownloadTooLargeError: If the download exceeds the maximum size for its content type
     :return:
     """
-    # download the file to a tempfile directory
-    with tempfile.TemporaryDirectory() as tempDirectory:
-        filepath = os.path.join(tempDirectory, 'file')
-        logger.debug(f"Downloading file to: {filepath}")
-        r = requests.get(url, allow_redirects=True, timeout=2)
+    key = entry = None
+    if cache is not None:
+        key = cache.key(url, extract_images=extract_images, strip_non_content=strip_non_content,
+                        enhance_images=enhance_images, **options)
+        entry = cache.get(key)
+
+    # download the document into memory, the size caps bound how much that can be
+    buffer = io.BytesIO()
+    r = _request(url, session=session, headers=HttpCache.conditional_headers(entry))
+    try:
+        if entry is not None and r.status_code == 304:
+            logger.debug(f"Not modified, using cached markdown: {url}")
+            return entry['markdown']
+        filemime = _read_body(r, buffer, url, max_bytes=max_bytes)
+        validators = HttpCache.validators(r.headers) if r.status_code == 200 else {}
+    finally:
+        r.close()
+
+    # extract the text from the document
+    text = extract_bytes(buffer.getvalue(), filemime=filemime, extract_images=extract_images,
+                         strip_non_content=strip_non_content, enhance_image_level=enhance_images, url=url,
+                         session=session, **options)
+
+    if cache is not None:
+        if text and validators:
+            cache.set(key, dict(validators, url=url, markdown=text))
+        elif entry is not None:
+            # the entry was for a version of the document we no longer have
+            cache.delete(key)
 
-        # try filemime from the headers
-        filemime = _normalize_mime_type(r.headers.get('content-type'))
+    return text
+
+
+def _request(url: str, session: requests.Session = None, headers: dict = None) -> requests.Response:
+    """
+    Start a streamed GET of a URL
+    :param url:
+    :param session: The requests session to use, defaults to the shared pooled session
+    :param headers: Extra request headers
+    :return: The response, the caller has to close it
+    """
+    logger.debug(f"Downloading: {url}")
+    return (session or get_session()).get(url, headers=headers or None, allow_redirects=True, timeout=2, stream=True)
 
-        with open(filepath, 'wb') as file:
-            file.write(r.content)
 
-        logger.debug(f"Downloaded file to: {filepath}")
+def _read_body(r: requests.Response, file: BinaryIO, url: str, max_bytes: dict | int = None) -> str:
+    """
+    Write the body of a streamed response to a binary file object
+    :param r:
+    :param file: Where to write the body
+    :param url:
+    :param max_bytes: Maximum download size, see download.max_bytes_for
+    :raises DownloadTooLargeError: If the download exceeds the maximum size for its content type
+    :return: The mimetype reported by the server, without parameters
+    """
+    # try filemime from the headers
+    filemime = _normalize_mime_type(r.headers.get('content-type'))
+    stream_to_file(r, file, max_bytes_for(filemime, max_bytes), url=url)
 
-        # extract the text from the file
-        text = extract(filepath, filemime=filemime, extract_images=extract_images, strip_non_content=strip_non_content,
-                       enhance_image_level=enhance_images, url=url)
+    logger.debug(f"Downloaded: {url}")
 
-    return text
+    return filemime
+
+
+def _download(url: str, file: BinaryIO, max_bytes: dict | int = None, session: requests.Session = None) -> str:
+    """
+    Stream a URL into a binary file object
+    :param url:
+    :param file: Where to write the downloaded body
+    :param max_bytes: Maximum download size, see download.max_bytes_for
+    :param session: The requests session to use, defaults to the shared pooled session
+    :raises DownloadTooLargeError: If the download exceeds the maximum size for its content type
+    :return: The mimetype reported by the server, without parameters
+    """
+    r = _request(url, session=session)
+    try:
+        return _read_body(r, file, url, max_bytes=max_bytes)
+    finally:
+        r.close()
 
 
 def get_filemime(filepath: str) -> str:
@@ -83,77 +174,44 @@ def extract(
         url: str = None,
         extract_images: bool = True,
         strip_non_content: bool = True,
-        enhance_image_level: int = 1
+        enhance_image_level: int = 1,
+        temp_directory: str = None,
+        **options
 ) -> str:
     """
 
     :param url:
     :param filepath: The filepath including filename and extension
-    :param filemime: The mimetype we believe this file should be
+    :param filemime: The mimetype we believe this file should be, overridden if the content has a clear signature
     :param _trying_again: Is this a retry of an alternative type
     :param alt_ext: A different extension to try e.g. ".pdf" 0 If specified, this is used instead of filemime
     :param extract_images: Extract text from images
     :param strip_non_content: Strip headers, footers, navigation etc
     :param enhance_image_level: Enhance images before extracting text
+    :param temp_directory: Optionally a directory already holding downloaded images for HTML documents
+    :param options: Passed through to the handler for the mimetype, see registry.HANDLERS. Pass result_cache, a
+      ResultCache, to reuse the markdown of a document with the same content that was extracted before.
     TODO: Add a parameter to specify the language for tesseract
-    TODO: Make this more modular, allowing handler files for each mimetype and allowing them to handle the file
-      so that new handlers can be easily plugged in by adding a new handler file
     :return: The text of the document in UTF-8
     """
 
     if not filemime:
         filemime = get_filemime(filepath)
 
-    if not filemime:
-        logger.error(f"Could not determine mimetype for {filepath}")
-        return ''
-
-    filemime = _normalize_mime_type(filemime)
-
     file_content = get_file_content(filepath, filemime)
 
-    if filemime == 'text/html':
-        logger.debug(f"Converting HTML to Markdown...")
-        text = md_from_html(file_content, url=url, extract_images=extract_images, strip_non_content=strip_non_content,
-                            enhance_image_level=enhance_image_level)
-        if text:
-            logger.debug(f"Got '{text[0:100]}...'")
-            return text
-        else:
-            logger.debug(f"Got nothing from HTML!")
-
-    elif filemime == 'application/pdf':
-        # Convert to html then call extract
-        with tempfile.TemporaryDirectory() as tempDirectory:
-            with tempfile.NamedTemporaryFile(delete=False, dir=tempDirectory, suffix='.html') as tmp:
-                # extract the text from the pdf
-                with open(filepath, 'rb') as file:
-                    extract_text_to_fp(io.BytesIO(file.read()), tmp, output_type='html', codec='utf-8', output_dir=tempDirectory,)
-                # read the text from the temporary file
-                tmp.seek(0)
-                content = get_file_content(tmp.name, 'text/html')
-                return md_from_html(content, url=url, temp_directory=tempDirectory, extract_images=extract_images,
-                                    strip_non_content=strip_non_content, enhance_image_level=enhance_image_level)
-
-    elif filemime == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
-        result = mammoth.convert_to_html(filepath)
-        return md_from_html(result.value, url=url)
-
-    elif filemime.startswith('image/'):
-        image_path = filepath
-        src = url if url else image_path
-        return extract_image_md(src, image_path, enhance_level=enhance_image_level)
-
-    elif filemime == 'application/vnd.openxmlformats-officedocument.presentationml.presentation':
-        return extract_pptx_md(filepath)
-    else:
-        # raise an error if we don't know how to handle this file type
-        logger.error(f"Unsupported mimetype: {filemime}")
-        return ''
+    # the content has the final say over what we were told
+    filemime = resolve_mimetype(file_content, _normalize_mime_type(filemime))
 
-        # Don't trust the user to give us a valid mimetype, or file extension - so try until we get something
+    if not filemime:
+        logger.error(f"Could not determine mimetype for {filepath}")
+        return ''
 
+    text = _extract_content(file_content, filemime, filepath=filepath, url=url, extract_images=extract_images,
+                            strip_non_content=strip_non_content, enhance_image_level=enhance_image_level,
+                            temp_directory=temp_directory, **options)
 
+    # Don't trust the user to give us a valid mimetype, or file extension - so try until we get something
     if not text and not _trying_again:
         # retry with common mimetypes in case it was incorrectly categorized
         alt_mimetype = get_filemime(filepath)
@@ -161,7 +219,7 @@ def extract(
             logger.debug(f"Trying alternative mimetype: {alt_mimetype}")
             text = extract(filepath, filemime=alt_mimetype, extract_images=extract_images,
                            strip_non_content=strip_non_content, enhance_image_level=enhance_image_level,
-                           _trying_again=True)
+                           _trying_again=True, **options)
 
         if not text:
             logger.error(f"Everything failed!")
@@ -170,6 +228,188 @@ def extract(
     return text
 
 
+def extract_bytes(
+        data: bytes | BinaryIO,
+        filemime: str = None,
+        url: str = None,
+        extract_images: bool = True,
+        strip_non_content: bool = True,
+        enhance_image_level: int = 1,
+        temp_directory: str = None,
+        **options
+) -> str:
+    """
+    Extract text from a document that is already in memory, without writing it to disk first
+    :param data: The document as bytes or a binary file object
+    :param filemime: The mimetype we believe this document should be, guessed from the url if not given and
+      overridden if the content has a clear signature
+    :param url: Where the document came from, used to resolve relative links
+    :param extract_images: Extract text from images
+    :param strip_non_content: Strip headers, footers, navigation etc
+    :param enhance_image_level: Enhance images before extracting text
+    :param temp_directory: Optionally a directory already holding downloaded images for HTML documents
+    :param options: Passed through to the handler for the mimetype, see registry.HANDLERS. Pass result_cache, a
+      ResultCache, to reuse the markdown of a document with the same content that was extracted before.
+    :return: The text of the document in UTF-8
+    """
+    if hasattr(data, 'read'):
+        data = data.read()
+
+    if not filemime and url:
+        filemime = get_filemime(urlparse(url).path)
+
+    # the content has the final say over what we were told
+    filemime = resolve_mimetype(data, _normalize_mime_type(filemime))
+
+    if not filemime:
+        logger.error(f"Could not determine mimetype for {url or 'in memory document'}")
+        return ''
+
+    text = _extract_content(data, filemime, url=url, extract_images=extract_images,
+                            strip_non_content=strip_non_content, enhance_image_level=enhance_image_level,
+                            temp_directory=temp_directory, **options)
+
+    if not text:
+        logger.error(f"Everything failed!")
+
+    logger.debug('extracted')
+    return text
+
+
+def iter_extract(
+        filepath: str,
+        filemime: str = None,
+        url: str = None,
+        extract_images: bool = True,
+        strip_non_content: bool = True,
+        enhance_image_level: int = 1,
+        **options
+) -> Iterator[str]:
+    """
+    Extract text from a file a page at a time, for formats with a page handler (PDF). Anything else is yielded whole.
+    :param filepath: The filepath including filename and extension
+    :param filemime: The mimetype we believe this file should be, overridden if the content has a clear signature
+    :param url:
+    :param extract_images: Extract text from images
+    :param strip_non_content: Strip headers, footers, navigation etc
+    :param enhance_image_level: Enhance images before extracting text
+    :param options: Passed through to the handler for the mimetype. For PDFs pages (zero-indexed page numbers) and
+      max_pages limit which pages are extracted.
+    :return: An iterator of the markdown of each page
+    """
+    if not filemime:
+        filemime = get_filemime(filepath)
+
+    yield from _iter_content(get_file_content(filepath, filemime), filemime, filepath=filepath, url=url,
+                             extract_images=extract_images, strip_non_content=strip_non_content,
+                             enhance_image_level=enhance_image_level, **options)
+
+
+def iter_extract_bytes(
+        data: bytes | BinaryIO,
+        filemime: str = None,
+        url: str = None,
+        extract_images: bool = True,
+        strip_non_content: bool = True,
+        enhance_image_level: int = 1,
+        **options
+) -> Iterator[str]:
+    """
+    Extract text from a document that is already in memory a page at a time, see iter_extract
+    :param data: The document as bytes or a binary file object
+    :param filemime: The mimetype we believe this document should be, guessed from the url if not given
+    :param url:
+    :param extract_images:
+    :param strip_non_content:
+    :param enhance_image_level:
+    :param options: Passed through to the handler for the mimetype
+    :return: An iterator of the markdown of each page
+    """
+    if hasattr(data, 'read'):
+        data = data.read()
+
+    if not filemime and url:
+        filemime = get_filemime(urlparse(url).path)
+
+    yield from _iter_content(data, filemime, url=url, extract_images=extract_images,
+                             strip_non_content=strip_non_content, enhance_image_level=enhance_image_level, **options)
+
+
+def _iter_content(file_content: bytes, filemime: str, **kwargs) -> Iterator[str]:
+    """
+    Convert a document with the page handler for its mimetype, or the handler if there isn't one
+    :param file_content: The raw document
+    :param filemime: The mimetype we believe this document should be
+    :param kwargs: Passed through to the handler
+    :return: An iterator of the markdown of each page
+    """
+    filemime = resolve_mimetype(file_content, _normalize_mime_type(filemime))
+    if not filemime:
+        logger.error(f"Could not determine mimetype for {kwargs.get('filepath') or kwargs.get('url')}")
+        return
+
+    page_handler = get_page_handler(filemime)
+    if page_handler is None:
+        yield _extract_content(file_content, filemime, **kwargs)
+        return
+
+    kwargs.pop('filepath', None)
+    kwargs.pop('result_cache', None)
+    yield from page_handler(file_content, **kwargs)
+
+
+def _extract_content(
+        file_content: bytes,
+        filemime: str,
+        filepath: str = None,
+        url: str = None,
+        extract_images: bool = True,
+        strip_non_content: bool = True,
+        enhance_image_level: int = 1,
+        temp_directory: str = None,
+        result_cache: ResultCache = None,
+        **options
+) -> str:
+    """
+    Convert the content of a document to markdown with the handler registered for its mimetype
+    :param file_content: The raw document
+    :param filemime: The normalized mimetype
+    :param filepath: The local file the content was read from, if any
+    :param url:
+    :param extract_images:
+    :param strip_non_content:
+    :param enhance_image_level:
+    :param temp_directory:
+    :param result_cache: Optionally a cache to look the result up in before extracting, and to store it in after
+    :param options: Passed through to the handler
+    :return: The markdown, or an empty string if nothing could be extracted
+    """
+    handler = get_handler(filemime)
+    if handler is None:
+        # raise an error if we don't know how to handle this file type
+        logger.error(f"Unsupported mimetype: {filemime}")
+        return ''
+
+    key = None
+    if result_cache is not None:
+        key = result_cache.key(file_content, filemime, url=url, filepath=filepath, extract_images=extract_images,
+                               strip_non_content=strip_non_content, enhance_image_level=enhance_image_level,
+                               **options)
+        entry = result_cache.get(key)
+        if entry is not None:
+            logger.debug(f"Using cached markdown for {filepath or url or 'in memory document'}")
+            return entry['markdown']
+
+    text = handler(file_content, filepath=filepath, url=url, extract_images=extract_images,
+                   strip_non_content=strip_non_content, enhance_image_level=enhance_image_level,
+                   temp_directory=temp_directory, **options)
+
+    if key is not None and text:
+        result_cache.set(key, {'markdown': text})
+
+    return text
+
+
 """
 Following functions courtesy of https://stackoverflow.com/a/1983219
 """
@@ -0,0 +1,135 @@
+import asyncio
+import concurrent.futures
+import functools
+import io
+import logging
+import os
+import tempfile
+from pathlib import Path
+from urllib.parse import urljoin
+
+import aiohttp
+
+from .download import DownloadTooLargeError, astream_to_file, create_async_session, max_bytes_for
+from .html import parse_html, strip_decoration
+from .image import REQUEST_HEADERS, remote_image_path
+from .sniff import resolve_mimetype
+
+logger = logging.getLogger(__name__)
+
+# Matches the 2 second connect/read timeout used by the blocking API
+DEFAULT_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=2, sock_read=2)
+
+
+async def aextract_from_url(
+        url: str,
+        extract_images: bool = True,
+        strip_non_content: bool = True,
+        enhance_images: bool = True,
+        session: aiohttp.ClientSession = None,
+        executor: concurrent.futures.Executor = None,
+        max_bytes: dict | int = None,
+        **options
+) -> str:
+    """
+    Extract text from a URL without blocking the event loop.
+    The document and every image it references are fetched concurrently on the event loop, parsing and OCR run on
+    an executor.
+    :param url:
+    :param extract_images:
+    :param strip_non_content:
+    :param enhance_images:
+    :param session: An aiohttp session to reuse, a new pooled one is created (and closed) if not given
+    :param executor: Executor for the CPU bound work, defaults to the event loop's default executor
+    :param max_bytes: Maximum download size, see download.max_bytes_for
+    :param options: Passed through to the handler for the document's mimetype
+    :raises DownloadTooLargeError: If the document exceeds the maximum size for its content type
+    :return:
+    """
+    # imported here as the package imports this module
+    from . import _normalize_mime_type, extract_bytes
+
+    own_session = session is None
+    if own_session:
+        session = create_async_session(timeout=DEFAULT_TIMEOUT)
+
+    try:
+        with tempfile.TemporaryDirectory() as tempDirectory:
+            logger.debug(f"Downloading: {url}")
+            buffer = io.BytesIO()
+            async with session.get(url, allow_redirects=True) as response:
+                # try filemime from the headers
+                filemime = _normalize_mime_type(response.headers.get('content-type'))
+                await astream_to_file(response, buffer, max_bytes_for(filemime, max_bytes), url=url)
+
+            logger.debug(f"Downloaded: {url}")
+            content = buffer.getvalue()
+
+            loop = asyncio.get_running_loop()
+            if extract_images and resolve_mimetype(content, filemime) == 'text/html':
+                # fetch the images up front so that extraction finds them already in the temp directory
+                sources = await loop.run_in_executor(executor, _find_image_sources, content, url, strip_non_content,
+                                                     options.get('html_parser'))
+                await asyncio.gather(*(adownload_image(src, tempDirectory, session, max_bytes=max_bytes)
+                                       for src in sources))
+
+            return await loop.run_in_executor(executor, functools.partial(
+                extract_bytes, content, filemime=filemime, extract_images=extract_images,
+                strip_non_content=strip_non_content, enhance_image_level=enhance_images, url=url,
+                temp_directory=tempDirectory, **options))
+    finally:
+        if own_session:
+            await session.close()
+
+
+def _find_image_sources(body, url: str = None, strip_non_content: bool = True, parser: str = None) -> list:
+    """
+    Find the unique remote image sources in an HTML document, resolved against the url. The document is parsed and
+    stripped the way md_from_html will, so only the images it goes on to extract are fetched.
+    :param body:
+    :param url:
+    :param strip_non_content: Leave out the images of headers, footers, navigation etc
+    :param parser: The tree builder to parse with, see html.HTML_PARSERS
+    :return:
+    """
+    soup = parse_html(body, parser)
+    if strip_non_content:
+        soup = strip_decoration(soup)
+    sources = []
+    for img in soup.find_all('img', src=True):
+        src = urljoin(url, img['src']) if url else img['src']
+        if src.startswith(('http://', 'https://')) and src not in sources:
+            sources.append(src)
+
+    return sources
+
+
+async def adownload_image(src: str, temp_directory: str, session: aiohttp.ClientSession,
+                          max_bytes: dict | int = None) -> str:
+    """
+    Download a remote image to the same location image.download_image would use
+    :param src:
+    :param temp_directory:
+    :param session:
+    :param max_bytes: Maximum download size, see download.max_bytes_for
+    :return: The path to the local file, or an empty string on failure
+    """
+    local_path = remote_image_path(src, temp_directory)
+    if os.path.exists(local_path):
+        return local_path
+
+    Path(local_path).parent.mkdir(parents=True, exist_ok=True)
+    try:
+        logger.debug(f"Downloading image: {src}")
+        async with session.get(src, headers=REQUEST_HEADERS) as response:
+            response.raise_for_status()
+            limit = max_bytes_for(response.headers.get('content-type') or 'image/', max_bytes)
+            with open(local_path, 'wb') as file:
+                await astream_to_file(response, file, limit, url=src)
+    except (aiohttp.ClientError, asyncio.TimeoutError, DownloadTooLargeError) as e:
+        logger.warning(f"Failed to retrieve image: {src}, due to: {e}")
+        if os.path.exists(local_path):
+            os.remove(local_path)
+        return ''
+
+    return local_path
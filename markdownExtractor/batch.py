@@ -0,0 +1,126 @@
+import concurrent.futures
+import logging
+import os
+import tempfile
+from typing import Iterable, Iterator, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def _is_url(source: str) -> bool:
+    """Anything with an http(s) scheme is downloaded, everything else is treated as a local path."""
+    return source.startswith(('http://', 'https://'))
+
+
+def _download_file(url: str, filepath: str, max_bytes: dict | int = None) -> str:
+    """
+    Download a URL to a file so the extraction process can pick it up
+    :param url:
+    :param filepath:
+    :param max_bytes: Maximum download size, see download.max_bytes_for
+    :return: The mimetype reported by the server
+    """
+    from . import _download
+
+    with open(filepath, 'wb') as file:
+        return _download(url, file, max_bytes=max_bytes)
+
+
+def extract_many(
+        sources: Iterable[str],
+        max_workers: int = None,
+        download_workers: int = 8,
+        extract_images: bool = True,
+        strip_non_content: bool = True,
+        enhance_image_level: int = 1,
+        executor: concurrent.futures.Executor = None,
+        max_bytes: dict | int = None,
+        **options
+) -> Iterator[Tuple[str, str]]:
+    """
+    Extract markdown from many URLs and/or local files, yielding results as they finish.
+    Downloads run on a thread pool so network waits overlap, while the CPU bound extraction (HTML parsing,
+    pdfminer, OCR) runs on a process pool so it is spread across all cores.
+    :param sources: URLs or local filepaths, read as the batch goes rather than all up front
+    :param max_workers: Number of extraction processes, defaults to the number of CPUs
+    :param download_workers: Number of concurrent downloads
+    :param extract_images: Extract text from images
+    :param strip_non_content: Strip headers, footers, navigation etc
+    :param enhance_image_level: Enhance images before extracting text
+    :param executor: Optionally an executor to run extraction on instead of a new process pool
+    :param max_bytes: Maximum download size, see download.max_bytes_for
+    :param options: Passed through to the handler for each document's mimetype
+    :return: An iterator of (source, markdown) tuples in completion order. Failed sources yield an empty string.
+    """
+    # imported here as the package imports this module
+    from . import extract
+
+    options = dict(options, extract_images=extract_images, strip_non_content=strip_non_content,
+                   enhance_image_level=enhance_image_level)
+
+    own_executor = executor is None
+    if own_executor:
+        from .image import init_ocr_worker
+
+        # the processes share the OCR threads rather than each starting one per CPU
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=init_ocr_worker,
+                                                          initargs=(max_workers or os.cpu_count() or 1,))
+
+    # only this many sources are downloading or extracting at once, the rest are read from sources as results are
+    # yielded, so a generator or a very long list is never held in memory
+    window = (max_workers or os.cpu_count() or 1) + download_workers
+    sources = enumerate(sources)
+
+    try:
+        with tempfile.TemporaryDirectory() as tempDirectory, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=download_workers) as downloader:
+            # future -> (source, filepath, downloading), filepath is only set for downloads
+            pending = {}
+
+            def submit_next() -> bool:
+                for index, source in sources:
+                    if _is_url(source):
+                        filepath = os.path.join(tempDirectory, str(index))
+                        pending[downloader.submit(_download_file, source, filepath, max_bytes)] = \
+                            (source, filepath, True)
+                    else:
+                        pending[executor.submit(extract, source, **options)] = (source, None, False)
+                    return True
+                return False
+
+            while len(pending) < window and submit_next():
+                pass
+
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    source, filepath, downloading = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.error(f"Failed to extract {source}: {e}")
+                        _remove(filepath)
+                        yield source, ''
+                        continue
+
+                    if downloading:
+                        # the download finished, hand the file over for extraction
+                        logger.debug(f"Downloaded {source}, queueing extraction")
+                        pending[executor.submit(extract, filepath, filemime=result, url=source, **options)] = \
+                            (source, filepath, False)
+                    else:
+                        # free the disk as we go rather than at the end of the batch
+                        _remove(filepath)
+                        yield source, result
+
+                while len(pending) < window and submit_next():
+                    pass
+    finally:
+        if own_executor:
+            executor.shutdown(cancel_futures=True)
+
+
+def _remove(filepath: str | None) -> None:
+    """Delete a downloaded file once it has been extracted, if there is one"""
+    if filepath is not None and os.path.exists(filepath):
+        os.remove(filepath)
@@ -0,0 +1,239 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from urllib.parse import urldefrag
+
+from .registry import DOCX_MIMETYPE
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# Options passed to handlers that don't change the markdown they produce
+NON_OUTPUT_OPTIONS = {'session', 'result_cache', 'temp_directory'}
+
+# Mimetypes whose markdown depends on the URL they came from, as links and images are resolved against it. A PDF only
+# does with the html engine, which writes the src of the images it extracts
+URL_DEPENDENT_MIMETYPES = {'text/html', DOCX_MIMETYPE, 'application/pdf'}
+
+
+def _options_key(options: dict) -> str:
+    """A stable string for a set of extraction options, values that aren't JSON are compared by repr"""
+    return json.dumps(options, sort_keys=True, default=repr)
+
+
+class DiskCache:
+    """
+    A directory of JSON entries with a total size bound. Writes are atomic (write to a temporary file then rename), so
+    several processes can share a directory. When the bound is exceeded the least recently used entries are deleted,
+    reading an entry updates its modification time.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        """
+        :param directory: Where to keep the entries, created if it doesn't exist
+        :param max_bytes: Total size of the entries to keep, or None for no bound
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # estimated size of the directory, None until the first write scans it
+        self._size = None
+        os.makedirs(directory, exist_ok=True)
+
+    def __repr__(self):
+        # part of the options when extracting, so it has to be stable across processes
+        return f'{type(self).__name__}({self.directory!r})'
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def get(self, key: str) -> dict | None:
+        """
+        Read an entry
+        :param key: A hex digest
+        :return: The entry, or None if it isn't cached
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                entry = json.load(file)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable cache entry {path}: {e}")
+            return None
+
+        return entry
+
+    def set(self, key: str, entry: dict) -> None:
+        """
+        Write an entry, replacing any existing one, then evict old entries if the cache is over its size bound
+        :param key: A hex digest
+        :param entry: Anything JSON serializable
+        :return:
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                json.dump(entry, file)
+            size = os.path.getsize(temp_path)
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+        if self.max_bytes is None:
+            return
+
+        if self._size is None:
+            self._size = sum(entry_size for _, _, entry_size in self._entries())
+        else:
+            self._size += size
+
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _entries(self):
+        """(path, mtime, size) for every entry, tolerating entries removed by another process while scanning"""
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith('.json'):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def evict(self) -> None:
+        """
+        Delete the least recently used entries until the cache fits within max_bytes
+        :return:
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        size = sum(entry_size for _, _, entry_size in entries)
+
+        for path, _, entry_size in entries:
+            if self.max_bytes is None or size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+            logger.debug(f"Evicted {path} from the cache")
+
+        self._size = size
+
+    def clear(self) -> None:
+        for path, _, _ in list(self._entries()):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._size = 0
+
+
+class HttpCache(DiskCache):
+    """
+    Cache of the markdown extracted from a URL together with the ETag / Last-Modified validators the server sent, so
+    a refresh can be a conditional request that returns the cached markdown on a 304 Not Modified.
+    """
+
+    @staticmethod
+    def key(url: str, **options) -> str:
+        """
+        :param url:
+        :param options: The extraction options, the same URL extracted with different options is cached separately.
+          Those in NON_OUTPUT_OPTIONS are ignored.
+        :return:
+        """
+        options = {name: value for name, value in options.items() if name not in NON_OUTPUT_OPTIONS}
+        return hashlib.sha256(f'{url}\n{_options_key(options)}'.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def validators(headers) -> dict:
+        """
+        The validators from a response's headers
+        :param headers:
+        :return: A dict with 'etag' and/or 'last_modified', empty if the response can't be revalidated
+        """
+        validators = {}
+        if headers.get('etag'):
+            validators['etag'] = headers.get('etag')
+        if headers.get('last-modified'):
+            validators['last_modified'] = headers.get('last-modified')
+        return validators
+
+    @staticmethod
+    def conditional_headers(entry: dict | None) -> dict:
+        """
+        The request headers to revalidate a cached entry
+        :param entry: The cached entry, or None
+        :return:
+        """
+        headers = {}
+        if not entry:
+            return headers
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+
+def _url_key(filemime: str, url: str | None, filepath: str | None, options: dict) -> str | None:
+    """The part of where a document came from that its markdown depends on, None if it doesn't"""
+    if filemime and filemime.startswith('image/'):
+        return url or filepath
+    if not url or filemime not in URL_DEPENDENT_MIMETYPES:
+        return None
+    if filemime == 'application/pdf' and (options.get('pdf_engine') not in (None, 'html')
+                                          or not options.get('extract_images', True)):
+        return None
+    # not just the directory, as fragment (#section), empty and query (?page=2) links resolve against the whole URL
+    return urldefrag(url).url
+
+
+class ResultCache(DiskCache):
+    """
+    Cache of extracted markdown keyed on a hash of the document's content and the options that affect the output, so
+    the same document reached through different URLs (mirrors, tracking parameters) is only extracted once.
+    """
+
+    @staticmethod
+    def key(file_content: bytes, filemime: str, url: str = None, filepath: str = None, **options) -> str:
+        """
+        :param file_content: The raw document
+        :param filemime: The mimetype it will be extracted as
+        :param url: Only part of the key for mimetypes in URL_DEPENDENT_MIMETYPES, whose links are resolved against it,
+          less any fragment, and for images, whose markdown uses the URL itself as the src
+        :param filepath: Only part of the key for images without a URL, which use it as the src instead
+        :param options: The extraction options, those in NON_OUTPUT_OPTIONS are ignored
+        :return:
+        """
+        if isinstance(file_content, str):
+            file_content = file_content.encode('utf-8')
+
+        base_url = _url_key(filemime, url, filepath, options)
+        options = {name: value for name, value in options.items() if name not in NON_OUTPUT_OPTIONS}
+
+        digest = hashlib.sha256(file_content)
+        digest.update(f'\n{filemime}\n{base_url}\n{_options_key(options)}'.encode('utf-8'))
+        return digest.hexdigest()
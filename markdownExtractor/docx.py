@@ -0,0 +1,298 @@
+import concurrent.futures
+import contextlib
+import io
+import logging
+import posixpath
+import re
+import zipfile
+from typing import Iterator
+from xml.etree import ElementTree
+
+import mammoth
+
+from .html import md_from_html
+from .image import extract_image_md
+
+logger = logging.getLogger(__name__)
+
+# 'html' converts the document to HTML with mammoth and converts that like any other page, 'stream' reads
+# word/document.xml a paragraph at a time and writes markdown directly
+DOCX_ENGINES = ('html', 'stream')
+DEFAULT_DOCX_ENGINE = 'html'
+
+W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+R = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+A = '{http://schemas.openxmlformats.org/drawingml/2006/main}'
+WP = '{http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing}'
+V = '{urn:schemas-microsoft-com:vml}'
+RELATIONSHIPS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+# Elements that only wrap runs, their runs are part of the paragraph's text
+_RUN_CONTAINERS = {W + 'ins', W + 'smartTag', W + 'sdt', W + 'sdtContent', W + 'fldSimple', W + 'customXml'}
+
+_HEADING_STYLE = re.compile(r'^heading\s*([1-6])$', re.IGNORECASE)
+
+
+def extract_docx(file_content: bytes, filepath: str = None, url: str = None, extract_images: bool = True,
+                 strip_non_content: bool = True, enhance_image_level: int = 1, temp_directory: str = None,
+                 **options) -> str:
+    """
+    Handler for word processing documents (.docx)
+    :param file_content: The raw document
+    :param filepath: unused, the document is read from file_content
+    :param url:
+    :param extract_images: OCR the images embedded in the document
+    :param strip_non_content: Only used by the html engine
+    :param enhance_image_level:
+    :param temp_directory:
+    :param options: docx_engine, one of DOCX_ENGINES, defaults to DEFAULT_DOCX_ENGINE.
+      ocr_workers, the number of images the stream engine OCRs at once, defaults to the executor's default.
+      session, the requests session the html engine downloads linked images with.
+      html_parser, the tree builder the html engine parses mammoth's HTML with, see html.HTML_PARSERS.
+      image_workers, the number of linked images the html engine downloads at once, see html.IMAGE_WORKERS.
+    :return:
+    """
+    engine = options.get('docx_engine') or DEFAULT_DOCX_ENGINE
+    if engine not in DOCX_ENGINES:
+        logger.error(f"Unknown DOCX engine: {engine}")
+        return ''
+
+    if engine == 'stream':
+        return _stream_docx_to_md(file_content, extract_images, enhance_image_level, options.get('ocr_workers'))
+
+    result = mammoth.convert_to_html(io.BytesIO(file_content))
+    return md_from_html(result.value, url=url, extract_images=extract_images, strip_non_content=strip_non_content,
+                        enhance_image_level=enhance_image_level, temp_directory=temp_directory,
+                        session=options.get('session'), parser=options.get('html_parser'),
+                        image_workers=options.get('image_workers'), triage=False)
+
+
+def _stream_docx_to_md(file_content: bytes, extract_images: bool, enhance_image_level: int,
+                       ocr_workers: int = None) -> str:
+    """
+    Convert a document to markdown a paragraph at a time, OCRing its images on a thread pool meanwhile
+    :param file_content:
+    :param extract_images:
+    :param enhance_image_level:
+    :param ocr_workers: Maximum number of images to OCR at once
+    :return:
+    """
+    with zipfile.ZipFile(io.BytesIO(file_content)) as docx:
+        relationships = _read_relationships(docx, 'word/_rels/document.xml.rels')
+        list_formats = _read_list_formats(docx)
+        list_counters = {}
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=ocr_workers) if extract_images else None
+        with executor or contextlib.nullcontext():
+            # markdown strings, or futures of the markdown for an image
+            blocks = []
+            # part name -> future, so an image used more than once is only OCRed once
+            ocr = {}
+            with docx.open('word/document.xml') as document:
+                for paragraph in _iter_paragraphs(document):
+                    images = []
+                    text = _paragraph_to_md(paragraph, relationships, list_formats, list_counters, images)
+                    if text:
+                        blocks.append(text)
+                    if executor is None:
+                        continue
+
+                    for relationship_id, alt_text in images:
+                        part = relationships.get(relationship_id)
+                        if not part or part.startswith(('http://', 'https://')) or part not in docx.namelist():
+                            continue
+                        if part not in ocr:
+                            # the worker reads the image itself, so only the images being OCRed are in memory
+                            # rather than every image queued behind them
+                            ocr[part] = executor.submit(_image_to_md, docx, part, alt_text, enhance_image_level)
+                        blocks.append(ocr[part])
+
+            text = '\n'.join(block if isinstance(block, str) else block.result() for block in blocks)
+
+    # tidy the same way md_from_html does
+    text = re.sub(r'\n{3,}', '\n\n', text)
+    text = re.sub(r' {3,}', '  ', text)
+    return text.strip()
+
+
+def _image_to_md(docx: zipfile.ZipFile, name: str, alt_text: str, enhance_image_level: int) -> str:
+    """Extract the text of an image embedded in the document, an image that can't be read is left out"""
+    try:
+        return extract_image_md(name, None, alt_text, enhance_level=enhance_image_level, image_data=docx.read(name))
+    except Exception as e:
+        logger.error(f"Failed to extract text from {name}: {e}")
+        return ''
+
+
+def _iter_paragraphs(document) -> Iterator[ElementTree.Element]:
+    """
+    Yield each paragraph of word/document.xml as soon as it has been parsed, and then drop it, so only one paragraph
+    (or table) of the document is held in memory at a time
+    :param document: A file object of word/document.xml
+    :return:
+    """
+    stack = []
+    for event, element in ElementTree.iterparse(document, events=('start', 'end')):
+        if event == 'start':
+            stack.append(element)
+            continue
+
+        stack.pop()
+        if element.tag == W + 'p':
+            yield element
+
+        if stack and stack[-1].tag == W + 'body':
+            stack[-1].remove(element)
+
+
+def _read_relationships(docx: zipfile.ZipFile, part: str) -> dict:
+    """
+    Map relationship ids to their targets, internal targets as the name of the part in the zip
+    :param docx:
+    :param part: The relationships part
+    :return:
+    """
+    try:
+        root = ElementTree.fromstring(docx.read(part))
+    except (KeyError, ElementTree.ParseError):
+        return {}
+
+    relationships = {}
+    for relationship in root.iter(RELATIONSHIPS + 'Relationship'):
+        target = relationship.get('Target', '')
+        if relationship.get('TargetMode') != 'External':
+            if target.startswith('/'):
+                target = target.lstrip('/')
+            else:
+                target = posixpath.normpath(posixpath.join(posixpath.dirname(posixpath.dirname(part)), target))
+        relationships[relationship.get('Id')] = target
+    return relationships
+
+
+def _read_list_formats(docx: zipfile.ZipFile) -> dict:
+    """
+    Map (numId, ilvl) of the lists in word/numbering.xml to their number format, e.g. 'bullet' or 'decimal'
+    :param docx:
+    :return:
+    """
+    try:
+        root = ElementTree.fromstring(docx.read('word/numbering.xml'))
+    except (KeyError, ElementTree.ParseError):
+        return {}
+
+    abstract_formats = {}
+    for abstract in root.iter(W + 'abstractNum'):
+        for level in abstract.iter(W + 'lvl'):
+            number_format = level.find(W + 'numFmt')
+            abstract_formats[(abstract.get(W + 'abstractNumId'), level.get(W + 'ilvl'))] = \
+                number_format.get(W + 'val') if number_format is not None else 'bullet'
+
+    list_formats = {}
+    for num in root.iter(W + 'num'):
+        abstract_id = num.find(W + 'abstractNumId')
+        if abstract_id is None:
+            continue
+        for (abstract, level), number_format in abstract_formats.items():
+            if abstract == abstract_id.get(W + 'val'):
+                list_formats[(num.get(W + 'numId'), level)] = number_format
+    return list_formats
+
+
+def _paragraph_to_md(paragraph: ElementTree.Element, relationships: dict, list_formats: dict, list_counters: dict,
+                     images: list) -> str:
+    """
+    Convert a paragraph to a line of markdown
+    :param paragraph: A w:p element
+    :param relationships: From _read_relationships
+    :param list_formats: From _read_list_formats
+    :param list_counters: (numId, ilvl) -> the number of the last item of each ordered list, updated
+    :param images: (relationship id, alt text) of each image in the paragraph is appended to this
+    :return:
+    """
+    text = _inline_to_md(paragraph, relationships, images).strip()
+    if not text:
+        return ''
+
+    properties = paragraph.find(W + 'pPr')
+    if properties is None:
+        return text
+
+    style = properties.find(W + 'pStyle')
+    style = style.get(W + 'val', '') if style is not None else ''
+    if style == 'Title':
+        return f"# {text}"
+    heading = _HEADING_STYLE.match(style)
+    if heading:
+        return f"{'#' * int(heading.group(1))} {text}"
+
+    numbering = properties.find(W + 'numPr')
+    if numbering is None:
+        return text
+
+    num_id = numbering.find(W + 'numId')
+    num_id = num_id.get(W + 'val') if num_id is not None else None
+    level = numbering.find(W + 'ilvl')
+    level = level.get(W + 'val', '0') if level is not None else '0'
+    indent = '  ' * int(level) if level.isdigit() else ''
+
+    if list_formats.get((num_id, level), 'bullet') in ('bullet', 'none'):
+        return f"{indent}* {text}"
+
+    # a shallower item restarts the numbering of the levels under it
+    for key in [key for key in list_counters if key[0] == num_id and int(key[1]) > int(level or 0)]:
+        del list_counters[key]
+    list_counters[(num_id, level)] = list_counters.get((num_id, level), 0) + 1
+    return f"{indent}{list_counters[(num_id, level)]}. {text}"
+
+
+def _inline_to_md(element: ElementTree.Element, relationships: dict, images: list) -> str:
+    """The markdown of the runs and hyperlinks in a paragraph, or anything else that wraps runs"""
+    parts = []
+    for child in element:
+        if child.tag == W + 'r':
+            parts.append(_run_to_md(child, images))
+        elif child.tag == W + 'hyperlink':
+            text = _inline_to_md(child, relationships, images)
+            target = relationships.get(child.get(R + 'id'))
+            if not target and child.get(W + 'anchor'):
+                target = f"#{child.get(W + 'anchor')}"
+            parts.append(f"[{text}]({target})" if target and text.strip() else text)
+        elif child.tag in _RUN_CONTAINERS:
+            parts.append(_inline_to_md(child, relationships, images))
+    return ''.join(parts)
+
+
+def _run_to_md(run: ElementTree.Element, images: list) -> str:
+    """The markdown of a run of text with the same formatting"""
+    parts = []
+    for child in run:
+        if child.tag == W + 't':
+            parts.append(child.text or '')
+        elif child.tag == W + 'tab':
+            parts.append('\t')
+        elif child.tag in (W + 'br', W + 'cr'):
+            parts.append('\n')
+        elif child.tag == W + 'drawing':
+            description = child.find(f'.//{WP}docPr')
+            alt_text = description.get('descr', '') if description is not None else ''
+            for blip in child.iter(A + 'blip'):
+                images.append((blip.get(R + 'embed'), alt_text))
+        elif child.tag == W + 'pict':
+            for image in child.iter(V + 'imagedata'):
+                images.append((image.get(R + 'id'), image.get('alt', '')))
+
+    text = ''.join(parts)
+    properties = run.find(W + 'rPr')
+    if not text.strip() or properties is None:
+        return text
+
+    if _is_on(properties.find(W + 'b')):
+        text = f"**{text}**"
+    if _is_on(properties.find(W + 'i')):
+        text = f"*{text}*"
+    return text
+
+
+def _is_on(toggle: ElementTree.Element | None) -> bool:
+    """Whether a formatting toggle like w:b is present and not switched off"""
+    return toggle is not None and toggle.get(W + 'val', 'true') not in ('0', 'false', 'off', 'none')
@@ -0,0 +1,168 @@
+import logging
+import os
+import threading
+from typing import BinaryIO
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Number of hosts to keep connection pools for, and how many keep-alive connections to hold per host
+POOL_CONNECTIONS = 20
+POOL_MAXSIZE = 10
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+CHUNK_SIZE = 64 * 1024
+
+# Maximum number of bytes to download per content type. Keys are either a full mimetype or a major type ending in '/',
+# the None key is used for anything else. Set a value to None to remove the cap for that type.
+MAX_DOWNLOAD_BYTES = {
+    'text/html': 20 * 1024 * 1024,
+    'application/pdf': 200 * 1024 * 1024,
+    'image/': 20 * 1024 * 1024,
+    None: 100 * 1024 * 1024,
+}
+
+
+class DownloadTooLargeError(Exception):
+    """Raised when a download exceeds the maximum size allowed for its content type"""
+
+    def __init__(self, url: str, max_bytes: int):
+        self.url = url
+        self.max_bytes = max_bytes
+        super().__init__(f"Download of {url} exceeded the maximum size of {max_bytes} bytes")
+
+
+def max_bytes_for(filemime: str, max_bytes: dict | int = None) -> int | None:
+    """
+    Find the download cap for a mimetype
+    :param filemime: The mimetype reported by the server, without parameters
+    :param max_bytes: Either a single cap for every type or a mapping like MAX_DOWNLOAD_BYTES. Defaults to
+      MAX_DOWNLOAD_BYTES
+    :return: The maximum number of bytes, or None for no cap
+    """
+    if max_bytes is None:
+        max_bytes = MAX_DOWNLOAD_BYTES
+
+    if not isinstance(max_bytes, dict):
+        return max_bytes
+
+    if filemime in max_bytes:
+        return max_bytes[filemime]
+
+    if filemime and '/' in filemime:
+        major_type = filemime.split('/', 1)[0] + '/'
+        if major_type in max_bytes:
+            return max_bytes[major_type]
+
+    return max_bytes.get(None)
+
+
+def _check_content_length(headers, url: str, limit: int | None) -> None:
+    """Abort before reading anything if the server already told us the body is too big"""
+    content_length = headers.get('content-length')
+    if limit is not None and isinstance(content_length, str) and content_length.isdigit() \
+            and int(content_length) > limit:
+        raise DownloadTooLargeError(url, limit)
+
+
+def stream_to_file(response, file: BinaryIO, limit: int | None, url: str = '') -> int:
+    """
+    Write a streamed requests response to a file in chunks, aborting once the limit is exceeded
+    :param response: A requests response opened with stream=True
+    :param file: A binary file object to write to
+    :param limit: Maximum number of bytes, or None for no cap
+    :param url: Used in the error message
+    :return: The number of bytes written
+    """
+    _check_content_length(response.headers, url, limit)
+
+    written = 0
+    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+        written += len(chunk)
+        if limit is not None and written > limit:
+            raise DownloadTooLargeError(url, limit)
+        file.write(chunk)
+
+    return written
+
+
+async def astream_to_file(response, file: BinaryIO, limit: int | None, url: str = '') -> int:
+    """
+    Async version of stream_to_file for an aiohttp response
+    :param response: An aiohttp response
+    :param file: A binary file object to write to
+    :param limit: Maximum number of bytes, or None for no cap
+    :param url: Used in the error message
+    :return: The number of bytes written
+    """
+    _check_content_length(response.headers, url, limit)
+
+    written = 0
+    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+        written += len(chunk)
+        if limit is not None and written > limit:
+            raise DownloadTooLargeError(url, limit)
+        file.write(chunk)
+
+    return written
+
+
+def create_session(pool_connections: int = None, pool_maxsize: int = None, max_retries: int = 0) -> requests.Session:
+    """
+    Create a requests session with a keep-alive connection pool
+    :param pool_connections: Number of hosts to keep pools for, defaults to POOL_CONNECTIONS
+    :param pool_maxsize: Maximum keep-alive connections per host, defaults to POOL_MAXSIZE
+    :param max_retries: Retries for failed connections
+    :return:
+    """
+    adapter = HTTPAdapter(pool_connections=pool_connections or POOL_CONNECTIONS,
+                          pool_maxsize=pool_maxsize or POOL_MAXSIZE, max_retries=max_retries)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    """
+    The session shared by every document and image download, so connections to the same host are reused.
+    A forked worker process gets a session of its own rather than sharing sockets with its parent.
+    :return:
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = create_session()
+            _session_pid = os.getpid()
+        return _session
+
+
+def set_session(session: requests.Session | None) -> None:
+    """
+    Replace the shared session, e.g. with one that has its own adapters, proxies or auth
+    :param session: The session to share, or None to create a default one on next use
+    :return:
+    """
+    global _session, _session_pid
+    with _session_lock:
+        _session = session
+        _session_pid = os.getpid()
+
+
+def create_async_session(limit: int = 100, limit_per_host: int = None, **kwargs):
+    """
+    Create an aiohttp session with a bounded keep-alive connection pool
+    :param limit: Maximum connections overall
+    :param limit_per_host: Maximum connections per host, defaults to POOL_MAXSIZE
+    :param kwargs: Passed to aiohttp.ClientSession
+    :return:
+    """
+    import aiohttp
+
+    connector = aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host or POOL_MAXSIZE)
+    return aiohttp.ClientSession(connector=connector, **kwargs)
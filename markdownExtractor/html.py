@@ -1,30 +1,165 @@
+import codecs
+import concurrent.futures
+import contextlib
+import itertools
 import logging
-from bs4 import BeautifulSoup, Comment
+from html.parser import HTMLParser
+from typing import Iterator
+
+from bs4 import BeautifulSoup, Comment, FeatureNotFound, NavigableString, Tag
+from bs4.builder import HTMLTreeBuilder
 from .image import download_and_extract_image_to_md
 import re
 import tempfile
 from urllib.parse import urljoin
-import copy
 
 logger = logging.getLogger(__name__)
 
+# Tree builders BeautifulSoup can parse with. 'html.parser' is pure Python and always available, 'lxml' is several times
+# faster and installed with python-pptx, 'html5lib' parses like a browser but is slower still. See set_html_parser.
+HTML_PARSERS = ('html.parser', 'lxml', 'html5lib')
+DEFAULT_HTML_PARSER = 'html.parser'
+
+# An html, head or body tag in the document, to tell them apart from those lxml and html5lib add
+_TAG_PATTERNS = {name: re.compile(rf'<{name}[\s/>]', re.IGNORECASE) for name in ('html', 'head', 'body')}
+_TAG_BYTES_PATTERNS = {name: re.compile(rf'<{name}[\s/>]'.encode('ascii'), re.IGNORECASE)
+                       for name in ('html', 'head', 'body')}
+
+# 'tree' parses the whole document with BeautifulSoup, 'stream' converts it as it is read, see iter_md_from_html
+HTML_ENGINES = ('tree', 'stream')
+DEFAULT_HTML_ENGINE = 'tree'
+
+# How much of a document the stream engine parses at a time
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# How many of a page's images are downloaded and extracted at once, mostly waiting on the network or on tesseract
+IMAGE_WORKERS = 8
+
+# Elements that are never part of the main content, removed whenever strip_non_content is set
+_SEMANTIC_DECORATION = ['header', 'footer', 'nav', 'aside']
+
+# Text directly inside these isn't part of the page's content
+_INVISIBLE_PARENTS = ['style', 'script', 'head', 'title', 'meta', '[document]']
+
+
 def tag_visible(element: BeautifulSoup) -> bool:
     """
     Given a BeautifulSoup element, return True if it should be visible in the output, False otherwise
     :param element:
     :return:
     """
-    if element.parent.name in ['style', 'script', 'head', 'title', 'meta', '[document]']:
+    if element.parent.name in _INVISIBLE_PARENTS:
         return False
     if isinstance(element, Comment):
         return False
     return True
 
 
+def set_html_parser(parser: str) -> None:
+    """
+    Change the tree builder md_from_html parses with when a call doesn't choose one
+    :param parser: One of HTML_PARSERS
+    :return:
+    """
+    global DEFAULT_HTML_PARSER
+    if parser not in HTML_PARSERS:
+        raise ValueError(f"Unknown HTML parser {parser!r}, expected one of {HTML_PARSERS}")
+    DEFAULT_HTML_PARSER = parser
+
+
+def parse_html(body, parser: str = None) -> BeautifulSoup:
+    """
+    Parse an HTML document, falling back to html.parser if the chosen parser isn't installed
+    :param body:
+    :param parser: One of HTML_PARSERS, defaults to DEFAULT_HTML_PARSER
+    :return:
+    """
+    parser = parser or DEFAULT_HTML_PARSER
+    try:
+        soup = BeautifulSoup(body, parser)
+    except FeatureNotFound:
+        logger.warning(f"HTML parser {parser} is not installed, falling back to html.parser")
+        return BeautifulSoup(body, 'html.parser')
+
+    if parser != 'html.parser':
+        _unwrap_implied_tags(soup, body)
+    return soup
+
+
+def _unwrap_implied_tags(soup: BeautifulSoup, body) -> None:
+    """
+    lxml and html5lib add the html, head and body tags a document leaves out, html.parser doesn't. Remove the ones that
+    weren't in the document, so that the text of a fragment is treated the same whichever parser read it.
+    :param soup:
+    :param body: The document that was parsed
+    :return:
+    """
+    if isinstance(body, (bytes, bytearray)):
+        patterns = _TAG_BYTES_PATTERNS
+    elif isinstance(body, str):
+        patterns = _TAG_PATTERNS
+    else:
+        return
+
+    # the added tags are always at the top of the tree
+    html = soup.find('html', recursive=False)
+    if html is None:
+        return
+    for tag in [html.find('body', recursive=False), html.find('head', recursive=False), html]:
+        if tag is not None and not patterns[tag.name].search(body):
+            tag.unwrap()
+
+
+def extract_html(file_content: bytes, filepath: str = None, url: str = None, extract_images: bool = True,
+                 strip_non_content: bool = True, enhance_image_level: int = 1, temp_directory: str = None,
+                 **options) -> str:
+    """
+    Handler for text/html
+    :param file_content: The raw HTML
+    :param filepath: unused, the HTML is read from file_content
+    :param url:
+    :param extract_images:
+    :param strip_non_content:
+    :param enhance_image_level:
+    :param temp_directory: Optionally a directory already holding downloaded images
+    :param options: session, the requests session to download images with.
+      html_parser, the tree builder to parse with, one of HTML_PARSERS.
+      html_engine, one of HTML_ENGINES, defaults to DEFAULT_HTML_ENGINE.
+      image_workers, the number of images the tree engine downloads and extracts at once, defaults to IMAGE_WORKERS.
+    :return:
+    """
+    engine = options.get('html_engine') or DEFAULT_HTML_ENGINE
+    if engine not in HTML_ENGINES:
+        logger.error(f"Unknown HTML engine: {engine}")
+        return ''
+
+    logger.debug(f"Converting HTML to Markdown...")
+    if engine == 'stream':
+        text = ''.join(iter_md_from_html(file_content, url=url, extract_images=extract_images,
+                                         strip_non_content=strip_non_content, enhance_image_level=enhance_image_level,
+                                         temp_directory=temp_directory, session=options.get('session')))
+    else:
+        text = md_from_html(file_content, url=url, extract_images=extract_images, strip_non_content=strip_non_content,
+                            enhance_image_level=enhance_image_level, temp_directory=temp_directory,
+                            session=options.get('session'), parser=options.get('html_parser'),
+                            image_workers=options.get('image_workers'))
+    if text:
+        logger.debug(f"Got '{text[0:100]}...'")
+    else:
+        logger.debug(f"Got nothing from HTML!")
+    return text
+
+
 def md_from_html(body, url=None, extract_images: bool = True, strip_non_content: bool = True,
-                 enhance_image_level: int = 2, temp_directory: str = None) -> str:
+                 enhance_image_level: int = 2, temp_directory: str = None, session=None, parser: str = None,
+                 image_workers: int = None, triage: bool = None) -> str:
     """
     Given an HTML document, extract the text from it, and return it as a string.
+    :param triage: Skip OCRing images unlikely to hold text, defaults to image.TRIAGE_DOWNLOADED_IMAGES. Documents
+      converted to HTML pass False, as their images are there for their content
+    :param image_workers: Maximum number of images to download and extract at once, defaults to IMAGE_WORKERS
+    :param parser: The tree builder to parse with, one of HTML_PARSERS, defaults to DEFAULT_HTML_PARSER
+    :param session: Optionally the requests session to download images with
     :param temp_directory: Optionally passed temporary directory to use for image extraction
     :param enhance_image_level:
     :param extract_images:
@@ -32,7 +167,7 @@ def md_from_html(body, url=None, extract_images: bool = True, strip_non_content:
     :param body:
     :param strip_non_content:
     """
-    soup = BeautifulSoup(body, 'html.parser')
+    soup = parse_html(body, parser)
     logger.debug(f"Converting HTML to Markdown...")
 
     # strip headers/footers/navigation etc
@@ -40,41 +175,515 @@ def md_from_html(body, url=None, extract_images: bool = True, strip_non_content:
         soup = strip_decoration(soup)
         logger.debug(f"stripped decoration...")
 
-    # convert relative links to absolute using the base_url if we have one
-    if url:
-        for link in soup.find_all('a', href=True):
-            link['href'] = urljoin(url, link['href'])
-        for img in soup.find_all('img', src=True):
-            img['src'] = urljoin(url, img['src'])
-
-    logger.debug(f"converted relative links to absolute...")
-
-    # Annotate hyperlinks with their href attribute
-    convert_links_to_markdown(soup)
-    logger.debug(f"converted links to markdown...")
-    convert_headings_to_markdown(soup)
-    logger.debug(f"converted headings to markdown...")
-    convert_emphasis_to_markdown(soup)
-    logger.debug(f"converted emphasis to markdown...")
-    convert_lists_to_markdown(soup)
-    logger.debug(f"converted lists to markdown...")
+    # convert the document in one walk, instead of a pass over the tree per kind of element
+    parts, images = _dom_to_md(soup, url, extract_images)
+    logger.debug(f"converted document to markdown...")
 
     # extract text from any embedded images
-    if extract_images:
-        convert_images_to_text(soup, enhance_level=enhance_image_level, temp_directory=temp_directory)
+    if images:
+        extracted = _extract_images([(src, alt_text) for _, src, alt_text in images], enhance_level=enhance_image_level,
+                                    temp_directory=temp_directory, session=session, image_workers=image_workers,
+                                    triage=triage)
+        for index, src, alt_text in images:
+            text_content = extracted[(src, alt_text)]
+            # an image without text adds nothing, not even a blank line
+            parts[index] = text_content.strip() if text_content else None
+        parts = [part for part in parts if part is not None]
         logger.debug(f"converted images to text...")
 
-    texts = soup.find_all(string=True)
-    visible_texts = filter(tag_visible, texts)
-    stripped = u"\n".join(t.strip() for t in visible_texts)
-
     # remove triple newlines or larger and triple spaces or larger (and replace with double)
-    stripped = re.sub(r'\n{3,}', '\n\n', stripped)
-    stripped = re.sub(r' {3,}', '  ', stripped)
+    stripped = _REPEATS.sub(lambda match: match.group()[:2], u"\n".join(parts))
 
     return stripped.strip()
 
 
+def iter_md_from_html(body, url=None, extract_images: bool = True, strip_non_content: bool = True,
+                      enhance_image_level: int = 2, temp_directory: str = None, session=None,
+                      encoding: str = None) -> Iterator[str]:
+    """
+    Convert an HTML document to markdown as it is read, without building a tree of the whole document, so memory use
+    stays flat however large the page is. The markdown follows the same rules as md_from_html, except that
+    strip_non_content only removes header, footer, nav and aside elements. md_from_html only strips the rest of what
+    looks like decoration if some content is left, which isn't known until the end of the page.
+    :param body: The document as str or bytes, a file object, or an iterable of str or bytes chunks
+    :param url:
+    :param extract_images:
+    :param strip_non_content:
+    :param enhance_image_level:
+    :param temp_directory:
+    :param session: Optionally the requests session to download images with
+    :param encoding: The encoding of a bytes document, defaults to the charset it declares, or utf-8
+    :return: Pieces of markdown that together are the markdown of the whole document
+    """
+    # (src, alt text) -> markdown, so an image used several times is only downloaded and OCRed once
+    extracted = {}
+
+    with contextlib.ExitStack() as stack:
+        def image_to_md(src: str, alt_text: str) -> str:
+            nonlocal temp_directory
+            if (src, alt_text) not in extracted:
+                if temp_directory is None:
+                    temp_directory = stack.enter_context(tempfile.TemporaryDirectory())
+                extracted[(src, alt_text)] = download_and_extract_image_to_md(src, temp_directory, alt_text=alt_text,
+                                                                              enhance_level=enhance_image_level,
+                                                                              session=session)
+            return extracted[(src, alt_text)]
+
+        parser = _MarkdownStreamParser(url, strip_non_content, image_to_md if extract_images else None)
+        yield from _tidy_stream(parser.convert(_iter_text_chunks(body, encoding)))
+
+
+# Runs of three or more newlines or spaces, both become a run of two
+_REPEATS = re.compile(r'\n{3,}| {3,}')
+
+_HEADING_LEVELS = {f'h{level}': level for level in range(1, 7)}
+
+# The order the convert_*_to_markdown functions run in, see _precedence
+_LINK = 0
+_BOLD = 7
+_ITALIC = 8
+_BULLET_ITEM = 9
+_NUMBERED_ITEM = 10
+
+
+def _precedence(name: str, attrs: dict, in_ul: bool, in_ol: bool) -> int | None:
+    """
+    When a tag would be converted if the convert_*_to_markdown functions were run one after another: links, then
+    headings from h1 to h6, then bold, then italic, then items of unordered and then ordered lists. The markdown of a
+    tag includes the markdown of the tags inside it that come earlier, but only the plain text of those that come later.
+    :param name: The tag's name
+    :param attrs: The tag's attributes
+    :param in_ul: Whether the tag is inside a ul
+    :param in_ol: Whether the tag is inside an ol
+    :return: The position in that order, or None if the tag isn't converted
+    """
+    if name == 'a':
+        return _LINK if 'href' in attrs else None
+    if name in _HEADING_LEVELS:
+        return _HEADING_LEVELS[name]
+    if name == 'b':
+        return _BOLD
+    if name == 'i':
+        return _ITALIC
+    if name == 'li':
+        return _BULLET_ITEM if in_ul else _NUMBERED_ITEM if in_ol else None
+    return None
+
+
+def _dom_to_md(soup: BeautifulSoup, url: str | None, extract_images: bool) -> tuple[list, list]:
+    """
+    Walk the document once, converting the same elements to markdown as convert_links_to_markdown,
+    convert_headings_to_markdown, convert_emphasis_to_markdown and convert_lists_to_markdown and keeping the visible
+    text as tag_visible does, without modifying the tree
+    :param soup:
+    :param url: Relative links and images are resolved against this
+    :param extract_images: Leave a place for the text of each image
+    :return: The stripped lines of text, and (index into the lines, src, alt text) for each image, whose line is None
+    """
+    parts = []
+    images = []
+
+    # (node, name of the parent its text ends up under, inside a ul, inside an ol, the item count of the outermost ol)
+    stack = [(child, soup.name, False, False, None) for child in reversed(soup.contents)]
+    while stack:
+        node, parent_name, in_ul, in_ol, counter = stack.pop()
+
+        if isinstance(node, NavigableString):
+            if not isinstance(node, Comment) and parent_name not in _INVISIBLE_PARENTS:
+                parts.append(node.strip())
+            continue
+
+        precedence = _precedence(node.name, node.attrs, in_ul, in_ol)
+        if precedence is not None:
+            text = _convert_to_md(node, precedence, in_ul, in_ol, url, counter)
+            if parent_name not in _INVISIBLE_PARENTS:
+                parts.append(text.strip())
+            continue
+
+        if node.name == 'img' and extract_images and 'src' in node.attrs:
+            src = urljoin(url, node['src']) if url else node['src']
+            images.append((len(parts), src, node.get('alt', '')))
+            parts.append(None)
+
+        if node.name == 'ol' and not in_ol:
+            counter = [0]
+        # lists are unwrapped, so their contents end up under the list's parent
+        if node.name not in ('ul', 'ol'):
+            parent_name = node.name
+        in_ul = in_ul or node.name == 'ul'
+        in_ol = in_ol or node.name == 'ol'
+        stack.extend((child, parent_name, in_ul, in_ol, counter) for child in reversed(node.contents))
+
+    return parts, images
+
+
+def _convert_to_md(tag: Tag, precedence: int, in_ul: bool, in_ol: bool, url: str | None, counter: list | None) -> str:
+    """The markdown a tag would be replaced with, see _precedence"""
+    if precedence == _NUMBERED_ITEM:
+        # items are numbered by their position among all the items of the outermost ol, nested ones included
+        counter[0] += 1
+        index = counter[0]
+
+    else:
+        index = None
+
+    text = _text_to_md(tag, precedence, in_ul, in_ol, url, counter)
+    href = (urljoin(url, tag['href']) if url else tag['href']) if precedence == _LINK else None
+    return _format_md(precedence, text, href, index)
+
+
+def _format_md(precedence: int, text: str, href: str = None, index: int = None) -> str:
+    """
+    The markdown for a converted tag
+    :param precedence: Which kind of tag it is, see _precedence
+    :param text: Its text
+    :param href: The link of an a tag
+    :param index: The number of an ordered list item
+    :return:
+    """
+    if precedence == _LINK:
+        return f"[{text}]({href})"
+    if precedence < _BOLD:
+        return f"{'#' * precedence} {text}"
+    if precedence == _BOLD:
+        return f"**{text}**"
+    if precedence == _ITALIC:
+        return f"*{text}*"
+    if precedence == _BULLET_ITEM:
+        return f"* {text}\n"
+    return f"{index}. {text}\n"
+
+
+def _text_to_md(tag: Tag, precedence: int, in_ul: bool, in_ol: bool, url: str | None, counter: list | None) -> str:
+    """
+    The text of a tag as get_text() would give it, with the tags inside it that are converted before it converted
+    :param tag:
+    :param precedence: The tag's position in the order of conversion
+    :return:
+    """
+    types = tag.interesting_string_types or Tag.MAIN_CONTENT_STRING_TYPES
+    parts = []
+
+    stack = [(child, in_ul or tag.name == 'ul', in_ol or tag.name == 'ol') for child in reversed(tag.contents)]
+    while stack:
+        node, node_in_ul, node_in_ol = stack.pop()
+
+        if isinstance(node, NavigableString):
+            if type(node) in types:
+                parts.append(node)
+            continue
+
+        node_precedence = _precedence(node.name, node.attrs, node_in_ul, node_in_ol)
+        if node_precedence is not None and node_precedence < precedence:
+            parts.append(_convert_to_md(node, node_precedence, node_in_ul, node_in_ol, url, counter))
+            continue
+        if node_precedence == _NUMBERED_ITEM == precedence:
+            # an item inside an item still takes a number
+            counter[0] += 1
+
+        node_in_ul = node_in_ul or node.name == 'ul'
+        node_in_ol = node_in_ol or node.name == 'ol'
+        stack.extend((child, node_in_ul, node_in_ol) for child in reversed(node.contents))
+
+    return ''.join(parts)
+
+
+class _Frame:
+    """A tag being converted to markdown by _MarkdownStreamParser, collecting its text until it closes"""
+    __slots__ = ('precedence', 'href', 'index', 'parent_name', 'parts')
+
+    def __init__(self, precedence: int, href: str | None, index: int | None, parent_name: str):
+        self.precedence = precedence
+        self.href = href
+        self.index = index
+        # the name of the parent its markdown ends up under, for tag_visible's rule
+        self.parent_name = parent_name
+        self.parts = []
+
+
+class _OpenTag:
+    """An element _MarkdownStreamParser has seen the start of but not the end"""
+    __slots__ = ('name', 'parent_name', 'in_ul', 'in_ol', 'counter', 'frame', 'owns_frame', 'skipped',
+                 'in_string_container', 'preserve_whitespace')
+
+    def __init__(self, name: str, parent_name: str, in_ul: bool, in_ol: bool, counter: list | None,
+                 frame: _Frame | None, owns_frame: bool, skipped: bool, in_string_container: bool,
+                 preserve_whitespace: bool):
+        self.name = name
+        # the name of the parent text inside this element ends up under, lists are unwrapped
+        self.parent_name = parent_name
+        self.in_ul = in_ul
+        self.in_ol = in_ol
+        self.counter = counter
+        # where text inside this element goes, None if it is a line of its own
+        self.frame = frame
+        self.owns_frame = owns_frame
+        # inside an element strip_non_content removes
+        self.skipped = skipped
+        # inside a script, style or other element whose strings get_text() leaves out
+        self.in_string_container = in_string_container
+        self.preserve_whitespace = preserve_whitespace
+
+
+class _MarkdownStreamParser(HTMLParser):
+    """
+    Writes markdown as elements close, by the same rules as _dom_to_md. It treats tags the way BeautifulSoup's
+    html.parser tree builder does, but only holds the open elements and the text of the tags being converted.
+    """
+
+    def __init__(self, url: str | None, strip_non_content: bool, image_to_md=None):
+        """
+        :param url: Relative links and images are resolved against this
+        :param strip_non_content: Leave out the elements in _SEMANTIC_DECORATION
+        :param image_to_md: Called with the src and alt text of each image to get its text, None to skip images
+        """
+        super().__init__(convert_charrefs=True)
+        self.url = url
+        self.strip_non_content = strip_non_content
+        self.image_to_md = image_to_md
+        # markdown written since convert last yielded, lines are separated by newlines as md_from_html joins them
+        self.output = []
+        self._has_output = False
+        self._data = []
+        # whether the text being read has been started as a line of its own, see handle_data
+        self._streaming = False
+        self._stack = [_OpenTag('[document]', '[document]', False, False, None, None, False, False, False, False)]
+
+    def convert(self, chunks) -> Iterator[str]:
+        """
+        Feed the document a chunk at a time
+        :param chunks: An iterable of str
+        :return: The markdown written by each chunk
+        """
+        for chunk in itertools.chain(chunks, [None]):
+            if chunk is None:
+                self.close()
+            else:
+                self.feed(chunk)
+            if self.output:
+                yield ''.join(self.output)
+                self.output = []
+
+    def close(self) -> None:
+        super().close()
+        self._flush_data()
+        # whatever is still open ends with the document
+        self._pop_to(1)
+
+    def handle_starttag(self, name: str, attrs: list) -> None:
+        self._flush_data()
+        parent = self._stack[-1]
+        attrs = {key: '' if value is None else value for key, value in attrs}
+        skipped = parent.skipped or (self.strip_non_content and name in _SEMANTIC_DECORATION)
+
+        frame = None
+        if not skipped:
+            precedence = _precedence(name, attrs, parent.in_ul, parent.in_ol)
+            if precedence is not None and (parent.frame is None or precedence < parent.frame.precedence):
+                index = None
+                if precedence == _NUMBERED_ITEM:
+                    parent.counter[0] += 1
+                    index = parent.counter[0]
+                href = None
+                if precedence == _LINK:
+                    href = urljoin(self.url, attrs['href']) if self.url else attrs['href']
+                frame = _Frame(precedence, href, index, parent.parent_name)
+            elif precedence == _NUMBERED_ITEM == parent.frame.precedence:
+                # an item inside an item still takes a number
+                parent.counter[0] += 1
+
+            if name == 'img' and parent.frame is None and self.image_to_md is not None and 'src' in attrs:
+                src = urljoin(self.url, attrs['src']) if self.url else attrs['src']
+                text_content = self.image_to_md(src, attrs.get('alt', ''))
+                if text_content:
+                    self._add_line(text_content.strip())
+
+        self._stack.append(_OpenTag(
+            name,
+            parent.parent_name if name in ('ul', 'ol') else name,
+            parent.in_ul or name == 'ul',
+            parent.in_ol or name == 'ol',
+            [0] if name == 'ol' and not parent.in_ol else parent.counter,
+            frame or parent.frame,
+            frame is not None,
+            skipped,
+            parent.in_string_container or name in HTMLTreeBuilder.DEFAULT_STRING_CONTAINERS,
+            parent.preserve_whitespace or name in HTMLTreeBuilder.DEFAULT_PRESERVE_WHITESPACE_TAGS,
+        ))
+        if name in HTMLTreeBuilder.DEFAULT_EMPTY_ELEMENT_TAGS:
+            self._pop_to(len(self._stack) - 1)
+
+    def handle_endtag(self, name: str) -> None:
+        self._flush_data()
+        # close the most recent element with this name and everything opened inside it, an end tag for an element
+        # that isn't open is ignored
+        for position in range(len(self._stack) - 1, 0, -1):
+            if self._stack[position].name == name:
+                self._pop_to(position)
+                return
+
+    def handle_data(self, data: str) -> None:
+        self._data.append(data)
+
+        tag = self._stack[-1]
+        if tag.skipped or tag.frame is not None or tag.parent_name in _INVISIBLE_PARENTS:
+            return
+        # the text is a line of its own, so write it as it arrives rather than hold a huge text node (a log dump in a
+        # pre) until the next tag. Only trailing whitespace is held back, as the line is stripped when it ends
+        text = ''.join(self._data)
+        if not self._streaming:
+            if not text.strip(BeautifulSoup.ASCII_SPACES):
+                # a string of nothing but whitespace is replaced with a single space or newline by _flush_data
+                return
+            text = text.lstrip()
+        end = len(text.rstrip())
+        if not end:
+            return
+
+        if self._streaming:
+            self.output.append(text[:end])
+        else:
+            self._add_line(text[:end])
+            self._streaming = True
+        self._data = [text[end:]]
+
+    def handle_comment(self, data: str) -> None:
+        self._flush_data()
+
+    def handle_decl(self, decl: str) -> None:
+        self._flush_data()
+        self._data.append(decl[len('DOCTYPE '):])
+        self._flush_data(main_content=False)
+
+    def unknown_decl(self, data: str) -> None:
+        self._flush_data()
+        is_cdata = data.upper().startswith('CDATA[')
+        self._data.append(data[len('CDATA['):] if is_cdata else data)
+        self._flush_data(main_content=is_cdata)
+
+    def handle_pi(self, data: str) -> None:
+        self._flush_data()
+        self._data.append(data)
+        self._flush_data(main_content=False)
+
+    def _flush_data(self, main_content: bool = True) -> None:
+        """
+        Add the text since the last tag as one string, as BeautifulSoup does
+        :param main_content: Whether it is a kind of string get_text() includes
+        :return:
+        """
+        if not self._data:
+            return
+        data = ''.join(self._data)
+        self._data = []
+
+        if self._streaming:
+            # the rest of a line handle_data has been writing
+            self._streaming = False
+            self.output.append(data.rstrip())
+            return
+
+        tag = self._stack[-1]
+        if not tag.preserve_whitespace and not data.strip(BeautifulSoup.ASCII_SPACES):
+            data = '\n' if '\n' in data else ' '
+
+        if tag.skipped:
+            return
+        if tag.frame is not None:
+            if main_content and not tag.in_string_container:
+                tag.frame.parts.append(data)
+        elif tag.parent_name not in _INVISIBLE_PARENTS:
+            self._add_line(data.strip())
+
+    def _add_line(self, text: str) -> None:
+        """Start a new line of markdown"""
+        if self._has_output:
+            self.output.append('\n')
+        self.output.append(text)
+        self._has_output = True
+
+    def _pop_to(self, position: int) -> None:
+        """Close the open elements from a position in the stack up, finishing the tags they were converting"""
+        while len(self._stack) > position:
+            tag = self._stack.pop()
+            if not tag.owns_frame:
+                continue
+
+            frame = tag.frame
+            markdown = _format_md(frame.precedence, ''.join(frame.parts), frame.href, frame.index)
+            outer = self._stack[-1].frame
+            if outer is not None:
+                outer.parts.append(markdown)
+            elif frame.parent_name not in _INVISIBLE_PARENTS:
+                self._add_line(markdown.strip())
+
+
+def _iter_text_chunks(body, encoding: str = None) -> Iterator[str]:
+    """
+    Read a document a chunk at a time, decoding bytes as they come
+    :param body: str or bytes, a file object, or an iterable of str or bytes chunks
+    :param encoding: The encoding of bytes, defaults to the charset declared in the first chunk, or utf-8
+    :return:
+    """
+    if isinstance(body, (str, bytes, bytearray)):
+        chunks = (body[start:start + STREAM_CHUNK_SIZE] for start in range(0, len(body), STREAM_CHUNK_SIZE))
+    elif hasattr(body, 'read'):
+        chunks = iter(lambda: body.read(STREAM_CHUNK_SIZE), body.read(0))
+    else:
+        chunks = body
+
+    decoder = None
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            yield chunk
+            continue
+        if decoder is None:
+            decoder = codecs.getincrementaldecoder(encoding or _declared_encoding(chunk) or 'utf-8')(errors='replace')
+        yield decoder.decode(chunk)
+
+    if decoder is not None:
+        yield decoder.decode(b'', final=True)
+
+
+_CHARSET_PATTERN = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?\s*([\w.:-]+)', re.IGNORECASE)
+
+
+def _declared_encoding(head: bytes) -> str | None:
+    """The encoding given by a byte order mark or a meta charset at the start of a document, if it is a known one"""
+    for bom, encoding in ((codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'),
+                          (codecs.BOM_UTF16_BE, 'utf-16')):
+        if head.startswith(bom):
+            return encoding
+
+    match = _CHARSET_PATTERN.search(head[:4096])
+    if not match:
+        return None
+    try:
+        return codecs.lookup(match.group(1).decode('ascii')).name
+    except LookupError:
+        return None
+
+
+def _tidy_stream(pieces: Iterator[str]) -> Iterator[str]:
+    """
+    Tidy markdown as md_from_html does, collapsing runs of newlines and spaces and stripping the ends, a piece at a
+    time. Trailing whitespace is held back until it's known whether more text follows it.
+    :param pieces:
+    :return:
+    """
+    held = ''
+    started = False
+    for piece in pieces:
+        text = held + piece
+        if not started:
+            text = text.lstrip()
+        end = len(text.rstrip())
+        held = text[end:]
+        if end:
+            started = True
+            yield _REPEATS.sub(lambda match: match.group()[:2], text[:end])
+
+
 def convert_links_to_markdown(soup: BeautifulSoup) -> None:
     """
     Given a BeautifulSoup object, find all links and convert them to markdown
@@ -139,27 +748,25 @@ def convert_lists_to_markdown(soup: BeautifulSoup) -> None:
         list_tag.unwrap()
 
 
-def strip_decoration(original_soup: BeautifulSoup) -> BeautifulSoup:
+def strip_decoration(soup: BeautifulSoup) -> BeautifulSoup:
     """
-    Given a BeautifulSoup object, attempt to remove all elements that are not part of the main content
-    :param original_soup:
+    Given a BeautifulSoup object, attempt to remove all elements that are not part of the main content. The soup is
+    modified in place.
+    :param soup:
     :return:
     """
 
     # Remove semantic elements, if they don't contain main content indicators
-    for tag_name in ['header', 'footer', 'nav', 'aside']:
-        for element in original_soup.find_all(tag_name):
+    for tag_name in _SEMANTIC_DECORATION:
+        for element in soup.find_all(tag_name):
             element.decompose()
-    # work on a copy of the soup so that we don't modify the original yet
-    # using python's copy module to avoid the "A copy of a bs4.element.Tag is not supported" error
-    soup = copy.copy(original_soup)
-
-    for element in soup.find_all('form'):
-        element.decompose()
 
-    if not len(soup.get_text(strip=True)):
-        # un-decompose the forms and try again
-        soup = copy.copy(original_soup)
+    # remove the forms too, unless all the content is inside them
+    types = soup.interesting_string_types
+    forms = [form for form in soup.find_all('form') if form.find_parent('form') is None]
+    if forms and _content_length(soup, types) > sum(_content_length(form, types) for form in forms):
+        for form in forms:
+            form.decompose()
 
     # Compile regular expression patterns
     unwanted_class_id_pattern = re.compile(
@@ -219,49 +826,104 @@ def _try_decomposing_elements(soup: BeautifulSoup, unwanted_pattern: re.Pattern,
 
         elements_to_decompose.append(element)
 
-    # Decompose collected elements
+    # Decompose collected elements, keeping track of how much content is left rather than checking the whole soup
+    types = soup.interesting_string_types
+    remaining = _content_length(soup, types)
     for element in elements_to_decompose:
-        backup_soup = copy.copy(soup)
-        if element.name is not None:
-            logger.debug(f"Decomposing: {element.name} {element.attrs}")
-            element.decompose()
-            if len(soup.get_text(strip=True)) == 0:
-                # restore the soup because stripping this element removed all content
-                logger.debug(f"Restoring soup because stripping {element.name} removed all content")
-                soup = backup_soup
+        if element.decomposed:
+            # already gone with an element around it
+            continue
+
+        length = _content_length(element, types)
+        if length == remaining:
+            # keep the element because stripping it would remove all content
+            logger.debug(f"Keeping {element.name} because stripping it would remove all content")
+            continue
 
-    logger.debug(f"Decomposed to:\n{soup.get_text()}")
+        logger.debug(f"Decomposing: {element.name} {element.attrs}")
+        element.decompose()
+        remaining -= length
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Decomposed to:\n{soup.get_text()}")
     return soup
 
 
-def convert_images_to_text(soup: BeautifulSoup, enhance_level=2, temp_directory: str = None) -> None:
+def _content_length(element: Tag, types) -> int:
+    """The length of the element's stripped text, counting the same kinds of string as the whole document does"""
+    return len(element.get_text(strip=True, types=types))
+
+
+def convert_images_to_text(soup: BeautifulSoup, enhance_level=2, temp_directory: str = None, session=None,
+                           image_workers: int = None) -> None:
     """
     Given a BeautifulSoup object, find all images and extract the text from them.
+    :param image_workers: Maximum number of images to download and extract at once, defaults to IMAGE_WORKERS
+    :param session: Optionally the requests session to download images with
     :param temp_directory:
     :param soup:
     :param enhance_level: Enhance the image before extracting the text
     :return:
     """
 
-    with tempfile.TemporaryDirectory() as tempDirectory:
-        preferred_temp_directory = temp_directory or tempDirectory
-        for img_tag in soup.find_all('img'):
-            # Extract the src attribute
-            if 'src' not in img_tag.attrs:
-                continue
+    img_tags = [img_tag for img_tag in soup.find_all('img') if 'src' in img_tag.attrs]
+    extracted = _extract_images([(img_tag['src'], img_tag.get('alt', '')) for img_tag in img_tags],
+                                enhance_level=enhance_level, temp_directory=temp_directory, session=session,
+                                image_workers=image_workers)
+
+    for img_tag in img_tags:
+        text_content = extracted[(img_tag['src'], img_tag.get('alt', ''))]
 
-            # Extract the alt attribute if it exists
-            alt_text = img_tag.get('alt', '')
+        if not text_content:
+            continue
 
-            text_content = download_and_extract_image_to_md(img_tag['src'], preferred_temp_directory, alt_text=alt_text,
-                                                            enhance_level=enhance_level)
+        # replace the img tag with the extracted text
+        text_node = soup.new_tag('span')
 
-            if not text_content:
-                continue
+        text_node.string = text_content
+        # Insert the text right after the img tag
+        img_tag.insert_after(text_node)
 
-            # replace the img tag with the extracted text
-            text_node = soup.new_tag('span')
 
-            text_node.string = text_content
-            # Insert the text right after the img tag
-            img_tag.insert_after(text_node)
+def _extract_images(images: list, enhance_level=2, temp_directory: str = None, session=None,
+                    image_workers: int = None, triage: bool = None) -> dict:
+    """
+    Download and extract the text from images, each distinct image once, several images at a time
+    :param images: (src, alt text) of each image
+    :param enhance_level:
+    :param temp_directory:
+    :param session:
+    :param image_workers: Maximum number of images to download and extract at once, defaults to IMAGE_WORKERS
+    :param triage: Skip OCRing images unlikely to hold text, defaults to image.TRIAGE_DOWNLOADED_IMAGES
+    :return: (src, alt text) -> markdown, so an image used several times is only downloaded and OCRed once
+    """
+    # src -> its distinct alt texts, which are extracted one after another so each src is only downloaded once
+    alt_texts = {}
+    for src, alt_text in images:
+        alts = alt_texts.setdefault(src, [])
+        if alt_text not in alts:
+            alts.append(alt_text)
+    if not alt_texts:
+        return {}
+
+    extracted = {}
+    with tempfile.TemporaryDirectory() as tempDirectory:
+        preferred_temp_directory = temp_directory or tempDirectory
+
+        def extract(src: str) -> dict:
+            return {(src, alt_text): download_and_extract_image_to_md(src, preferred_temp_directory,
+                                                                      alt_text=alt_text, enhance_level=enhance_level,
+                                                                      session=session, triage=triage)
+                    for alt_text in alt_texts[src]}
+
+        workers = min(image_workers or IMAGE_WORKERS, len(alt_texts))
+        if workers <= 1:
+            for src in alt_texts:
+                extracted.update(extract(src))
+        else:
+            logger.debug(f"Extracting {len(alt_texts)} images on {workers} threads")
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                for result in executor.map(extract, alt_texts):
+                    extracted.update(result)
+
+    return extracted
@@ -1,28 +1,108 @@
 import base64
-import hashlib
 import cairosvg
 import cv2
-from PIL import Image, ImageEnhance, ImageFilter, UnidentifiedImageError
-import numpy as np
+import concurrent.futures
+from collections import Counter
+import hashlib
+import importlib
+from PIL import Image, ImageEnhance, UnidentifiedImageError
 import os
 import io
+import math
+import numpy as np
 import requests
 import pytesseract
 import re
-import tempfile
+import threading
 from pathlib import Path
 import logging
 from urllib.parse import urlparse
 from urllib.request import url2pathname
 
+from .download import DownloadTooLargeError, get_session, max_bytes_for, stream_to_file
+
 logger = logging.getLogger(__name__)
 
+# How many images are OCRed at once across the whole process, tesseract runs as a subprocess so threads overlap fully
+OCR_WORKERS = os.cpu_count() or 1
+
+_ocr_executor = None
+_ocr_executor_pid = None
+_ocr_executor_lock = threading.Lock()
+# set on the threads running OCR, which OCR any image they come across themselves rather than wait on the executor
+_ocr_thread = threading.local()
+
+# 'pytesseract' starts a tesseract process per image, which loads the language model every time. 'tesserocr' keeps a
+# tesseract API loaded on each OCR thread and hands it the image in memory, it needs the optional tesserocr package.
+# See set_ocr_engine.
+OCR_ENGINES = ('pytesseract', 'tesserocr')
+OCR_ENGINE = 'pytesseract'
+
+# Before enhancing, an image is scaled to bring its text to about OCR_TEXT_HEIGHT pixels tall, the height of a line
+# of lowercase letters as measured by _estimate_text_height. The scale is kept between OCR_MIN_SCALE and OCR_MAX_SCALE,
+# and never makes the image larger than OCR_MAX_PIXELS, see _ocr_scale. A JPEG over OCR_MAX_PIXELS is decoded in draft
+# mode, at a fraction of its size.
+OCR_TEXT_HEIGHT = 48
+OCR_MIN_SCALE = 0.25
+OCR_MAX_SCALE = 6
+OCR_MAX_PIXELS = 12_000_000
+# text height is measured on a copy of about this many pixels at most, and not at all on images smaller than the minimum
+_TEXT_ESTIMATE_MAX_PIXELS = 4_000_000
+_TEXT_ESTIMATE_MIN_SIDE = 16
+
+# Downloaded images are triaged before OCR, skipping those unlikely to hold any text: spacers and tracking pixels
+# smaller than these, images without strokes (blank or smooth gradients), and photographs busy all over, whose text
+# would have nowhere flat to sit. See _triage_image.
+TRIAGE_DOWNLOADED_IMAGES = True
+TRIAGE_MIN_SIDE = 8
+TRIAGE_MIN_PIXELS = 24 * 24
+# fraction of pixels on a Canny edge. Text is usually well above 0.01, but the faint print of a light scan can be as low
+# as 0.001 while blank images, JPEG noise included, have none at all
+TRIAGE_MIN_EDGE_DENSITY = 0.0005
+# Canny's hysteresis thresholds, low enough to find strokes only a few grey levels darker than the paper
+TRIAGE_CANNY_THRESHOLDS = (30, 60)
+# fraction of pixels with little gradient around them, text on a background is usually above 0.5
+TRIAGE_MIN_FLAT_FRACTION = 0.3
+# images are shrunk to this before measuring, which is plenty to see strokes
+TRIAGE_MAX_SIDE = 512
+
+# how many images have been triaged, and how many were skipped for each reason, see get_triage_counts
+_triage_counts = Counter()
+_triage_counts_lock = threading.Lock()
+
+REQUEST_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 '
+                  'Safari/537.36'
+}
+
+
+def extract_image(file_content: bytes, filepath: str = None, url: str = None, extract_images: bool = True,
+                  strip_non_content: bool = True, enhance_image_level: int = 1, temp_directory: str = None,
+                  **options) -> str:
+    """
+    Handler for image/*
+    :param file_content: The raw image
+    :param filepath: The local file, if the image was read from one
+    :param url: Used as the image src in the markdown
+    :param enhance_image_level:
+    :return:
+    """
+    if filepath:
+        src = url if url else filepath
+        return extract_image_md(src, filepath, enhance_level=enhance_image_level)
+
+    src = url if url else 'local.img'
+    return extract_image_md(src, None, enhance_level=enhance_image_level, image_data=file_content)
+
+
 def download_and_extract_image_to_md(
         src: str,
         temp_directory: str,
         alt_text: str = '',
         enhance_level: int = 0,
-        include_empty=False) -> str:
+        include_empty=False,
+        session: requests.Session = None,
+        triage: bool = None) -> str:
     """
     Download an image, extract text and convert to markdown
     :param src: src as it appears in the image tag or a URL, can be a data URL
@@ -30,10 +110,12 @@ def download_and_extract_image_to_md(
     :param alt_text: alt_text as it appears in the image tag
     :param enhance_level:
     :param include_empty:
+    :param session: The requests session to download with, defaults to the shared pooled session
+    :param triage: Skip OCRing images unlikely to hold text, defaults to TRIAGE_DOWNLOADED_IMAGES
     :return:
     """
     logger.debug(f"Downloading image: {src}")
-    local_path = download_image(src, temp_directory)
+    local_path = download_image(src, temp_directory, session=session)
     logger.debug(f"Downloaded image to: {local_path}")
     if not local_path:
         logger.error(src + ' failed to download')
@@ -45,11 +127,12 @@ def download_and_extract_image_to_md(
 
     logger.debug(f"Downloaded image to: {local_path}")
 
-    return extract_image_md(src, local_path, alt_text, enhance_level=enhance_level, include_empty=include_empty)
+    return extract_image_md(src, local_path, alt_text, enhance_level=enhance_level, include_empty=include_empty,
+                            triage=TRIAGE_DOWNLOADED_IMAGES if triage is None else triage)
 
 
-def extract_image_md(src: str, local_path: str, alt_text: str = '', enhance_level: int = 1, include_empty=False,
-                     text_threshold: int = 512) -> str:
+def extract_image_md(src: str, local_path: str | None, alt_text: str = '', enhance_level: int = 1, include_empty=False,
+                     text_threshold: int = 512, image_data: bytes = None, triage: bool = False) -> str:
     """
     Extract text from a local image and convert to markdown
     :param src:
@@ -57,10 +140,12 @@ def extract_image_md(src: str, local_path: str, alt_text: str = '', enhance_leve
     :param alt_text:
     :param enhance_level:
     :param include_empty:
+    :param image_data: The image itself, used instead of reading local_path
+    :param triage: Skip OCRing the image if it is unlikely to hold text
     :return:
     """
     # Extract text from the image
-    extracted_text = extract_image_text(local_path, enhance_level=enhance_level)
+    extracted_text = extract_image_text(local_path, enhance_level=enhance_level, image_data=image_data, triage=triage)
     if extracted_text and len(extracted_text) > text_threshold:
         # don't extract the text as an image, it was likely actually scanned text
         # return the text as just text
@@ -115,18 +200,16 @@ def _image_data_to_markdown(src, alt_text, extracted_text, include_empty=False)
     return text_content
 
 
-def download_image(src: str, temp_directory: str) -> str:
+def download_image(src: str, temp_directory: str, max_bytes: dict | int = None,
+                   session: requests.Session = None) -> str:
     """
     Download an image, or extract it from a data URL and save it to a file in the temp_directory
     :param src:
     :param temp_directory:
+    :param max_bytes: Maximum download size, see download.max_bytes_for
+    :param session: The requests session to download with, defaults to the shared pooled session
     :return: The path to the local file
     """
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 '
-                      'Safari/537.36'
-    }
-
     # A possible local path for the image if the html os local
     possible_local_path = os.path.join(temp_directory, os.path.basename(src))
     # Regular expression to match data URL and extract MIME type
@@ -161,28 +244,31 @@ def download_image(src: str, temp_directory: str) -> str:
         # we already have a local copy in the temporary directory
         return possible_local_path
     elif src.startswith(('http://', 'https://')):
-        try:
-            logger.debug(f"Downloading image: {src}")
-            response = requests.get(src, headers=headers, timeout=2)
-            response.raise_for_status()  # This will raise an HTTPError if the HTTP request returned an unsuccessful
-            # status code
-        except requests.exceptions.RequestException as e:
-            logger.warning(f"Failed to retrieve image: {src}, due to: {e}")
-            return ''
-
-        # Generate a file name based on the URL's hash
-        extension = os.path.basename(src).split('.')[-1].split('?')[0]
-        if not extension:
-            extension = 'img'
+        local_path = remote_image_path(src, temp_directory)
+        if os.path.exists(local_path):
+            # already fetched, e.g. prefetched by the async API
+            return local_path
 
-        file_name = hashlib.md5(src.encode()).hexdigest() + '.' + extension
-        local_path = os.path.join(temp_directory, 'images', file_name)
         logger.debug(f" ======  Saving image to: {local_path}")
         Path(local_path).parent.mkdir(parents=True, exist_ok=True)
 
-        with open(local_path, 'wb') as file:
-            logger.debug(f"Writing image to: {local_path}")
-            file.write(response.content)  # Write the entire content at once
+        try:
+            logger.debug(f"Downloading image: {src}")
+            response = (session or get_session()).get(src, headers=REQUEST_HEADERS, timeout=2, stream=True)
+            try:
+                response.raise_for_status()  # This will raise an HTTPError if the HTTP request returned an
+                # unsuccessful status code
+                limit = max_bytes_for(response.headers.get('content-type') or 'image/', max_bytes)
+                with open(local_path, 'wb') as file:
+                    logger.debug(f"Writing image to: {local_path}")
+                    stream_to_file(response, file, limit, url=src)
+            finally:
+                response.close()
+        except (requests.exceptions.RequestException, DownloadTooLargeError) as e:
+            logger.warning(f"Failed to retrieve image: {src}, due to: {e}")
+            if os.path.exists(local_path):
+                os.remove(local_path)
+            return ''
 
         return local_path
 
@@ -192,6 +278,21 @@ def download_image(src: str, temp_directory: str) -> str:
         return ''
 
 
+def remote_image_path(src: str, temp_directory: str) -> str:
+    """
+    The local path a remote image is saved to, a file name based on the URL's hash
+    :param src:
+    :param temp_directory:
+    :return:
+    """
+    extension = os.path.basename(src).split('.')[-1].split('?')[0]
+    if not extension:
+        extension = 'img'
+
+    file_name = hashlib.md5(src.encode()).hexdigest() + '.' + extension
+    return os.path.join(temp_directory, 'images', file_name)
+
+
 def _resolve_file_uri(uri: str) -> Path:
     """Resolve a file URI to a local Path."""
     parsed = urlparse(uri)
@@ -246,29 +347,131 @@ def convert_svg_to_png(svg_path: str, output_width: int = 1000, output_height: i
     return Image.open(io.BytesIO(png_data))
 
 
-def extract_image_text(local_path: str, enhance_level: int = 1) -> str:
+def _looks_like_svg(image_data: bytes) -> bool:
+    """Cheap check for SVG markup at the start of an in memory image"""
+    head = image_data[:1024].lstrip()
+    return head.startswith(b'<svg') or (head.startswith(b'<?xml') and b'<svg' in head)
+
+
+def get_ocr_executor() -> concurrent.futures.Executor:
+    """
+    The executor shared by every OCR job, so the number of tesseract processes running at once is bounded however many
+    documents and images are being extracted. A forked worker process gets an executor of its own.
+    :return:
+    """
+    global _ocr_executor, _ocr_executor_pid
+    with _ocr_executor_lock:
+        if _ocr_executor is None or _ocr_executor_pid != os.getpid():
+            _ocr_executor = concurrent.futures.ThreadPoolExecutor(max_workers=OCR_WORKERS,
+                                                                  thread_name_prefix='markdownExtractor-ocr')
+            _ocr_executor_pid = os.getpid()
+        return _ocr_executor
+
+
+def set_ocr_executor(executor: concurrent.futures.Executor | None) -> None:
+    """
+    Replace the shared OCR executor, e.g. with a bigger thread pool or a process pool. The old one is not shut down.
+    :param executor: The executor to OCR on, or None to create a default one of OCR_WORKERS threads on next use
+    :return:
+    """
+    global _ocr_executor, _ocr_executor_pid
+    with _ocr_executor_lock:
+        _ocr_executor = executor
+        _ocr_executor_pid = os.getpid()
+
+
+def init_ocr_worker(processes: int) -> None:
+    """
+    Initializer for a pool of worker processes, sharing the OCR threads out among them. Each process otherwise gets a
+    pool of OCR_WORKERS threads of its own, so a pool of one process per CPU would run CPUs squared tesseracts at once.
+    :param processes: The number of processes in the pool
+    :return:
+    """
+    global OCR_WORKERS
+    OCR_WORKERS = max(1, OCR_WORKERS // processes)
+    set_ocr_executor(None)
+
+
+def extract_image_text(local_path: str | None, enhance_level: int = 1, image_data: bytes = None,
+                       triage: bool = False) -> str:
     """
-    Extract raw text from an image via OCR
+    Extract raw text from an image via OCR, on the shared OCR executor
     :param local_path:
     :param enhance_level:
+    :param image_data: The image itself, used instead of reading local_path
+    :param triage: Return nothing for images _triage_image says are unlikely to hold text, without OCRing them
     :return:
     """
-    if local_path.endswith('.svg'):
+    if getattr(_ocr_thread, 'active', False):
+        return _extract_image_text(local_path, enhance_level, image_data, triage)
+    return get_ocr_executor().submit(_run_ocr, local_path, enhance_level, image_data, triage).result()
+
+
+def _run_ocr(local_path: str | None, enhance_level: int, image_data: bytes | None, triage: bool = False) -> str:
+    """Run one OCR job on an executor thread, marking the thread as an OCR thread meanwhile"""
+    _ocr_thread.active = True
+    try:
+        return _extract_image_text(local_path, enhance_level, image_data, triage)
+    finally:
+        _ocr_thread.active = False
+
+
+def _extract_image_text(local_path: str | None, enhance_level: int = 1, image_data: bytes = None,
+                        triage: bool = False) -> str:
+    """Extract raw text from an image via OCR, on the calling thread"""
+    if local_path is None:
+        local_path = 'in memory image'
+
+    if image_data is None and local_path.endswith('.svg'):
         img = convert_svg_to_png(local_path)
     else:
-        with open(local_path, 'rb') as file:
+        if image_data is None:
+            with open(local_path, 'rb') as file:
+                image_data = file.read()
+
+        if _looks_like_svg(image_data):
+            png_data = cairosvg.svg2png(bytestring=image_data, output_width=1000, output_height=1000)
+            img = Image.open(io.BytesIO(png_data))
+        else:
             try:
-                img = Image.open(io.BytesIO(file.read()))
+                img = Image.open(io.BytesIO(image_data))
             except UnidentifiedImageError:
                 logger.error(f"Failed to open image: {local_path}")
                 return ''
 
     if enhance_level > 0:
+        budget_scale = math.sqrt(OCR_MAX_PIXELS / (img.width * img.height))
+        if budget_scale < 1 and img.format == 'JPEG':
+            # it is going to be shrunk at least this much, so decode it at a fraction of the size instead of in full.
+            # This only reads the header, so it has to happen before anything decodes the image
+            img.draft(img.mode, (math.ceil(img.width * budget_scale), math.ceil(img.height * budget_scale)))
+
+    if triage:
+        reason = _triage_image(img)
+        _count_triage(reason)
+        if reason:
+            logger.debug(f"Skipping OCR of {local_path}, {reason.replace('_', ' ')}")
+            return ''
+
+    if enhance_level > 0:
+        # estimating the text height is not free, so only do it for images that are going to be OCRed
+        scale = _ocr_scale(img)
+        new_size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+
+    if enhance_level > 1:
+        logger.debug(f"Scaling {local_path} by {scale:.2f} to {new_size[0]}x{new_size[1]}")
+        try:
+            img = _binarize(img, new_size)
+        except OSError:
+            logger.error(f"Failed to resize image: {local_path}")
+            return ''
+
+    elif enhance_level > 0:
         # Resize the image
-        scale_factor = 6
-        new_size = (img.width * scale_factor, img.height * scale_factor)
+        logger.debug(f"Scaling {local_path} by {scale:.2f} to {new_size[0]}x{new_size[1]}")
         try:
-            img = img.resize(new_size, Image.LANCZOS)
+            if (img.width, img.height) != new_size:
+                img = img.resize(new_size, Image.LANCZOS)
         except OSError:
             logger.error(f"Failed to resize image: {local_path}")
             return ''
@@ -283,42 +486,202 @@ def extract_image_text(local_path: str, enhance_level: int = 1) -> str:
         img = enhancer.enhance(1.5)
         # img.save("contrast_enhanced_image.png")  # Save the contrast-enhanced image
 
-        if enhance_level > 1:
-            open_cv_image = np.array(img)
-            # Convert RGB to BGR
-            if len(open_cv_image.shape) == 3:
-                # Image is in color (3D), so reverse color channels
-                open_cv_image = open_cv_image[:, :, ::-1].copy()
+        # Convert to grayscale
+        img = img.convert('L')
 
-            # Convert the image to grayscale only if it has 3 channels
-            if open_cv_image.shape[-1] == 3:
-                gray = cv2.cvtColor(open_cv_image, cv2.COLOR_BGR2GRAY)
-            else:
-                gray = open_cv_image
-            # cv2.imwrite("greyscale_image.png", gray)  # Save the blurred image
+    if OCR_ENGINE == 'tesserocr':
+        text_values, conf_values = _tesserocr_words(img)
+    else:
+        custom_config = r'--oem 3 --psm 4'
+        # Perform OCR
+        data = pytesseract.image_to_data(img, output_type=pytesseract.Output.DICT, config=custom_config)
+        text_values, conf_values = data.get('text', []), data.get('conf', [])
 
-            # Apply Gaussian Blur
-            blur = cv2.GaussianBlur(gray, (3, 3), 0)
-            # cv2.imwrite("blurred_image.png", blur)  # Save the blurred image
+    return _confident_text(text_values, conf_values)
 
-            # Apply Global Thresholding
-            _, thresh = cv2.threshold(blur, 127, 255, cv2.THRESH_BINARY)
-            # cv2.imwrite("thresholded_image.png", thresh)  # Save the thresholded image
 
-            # Convert back to PIL Image
-            img = Image.fromarray(thresh)
+def set_ocr_engine(engine: str) -> None:
+    """
+    Change how images are OCRed, falling back to pytesseract if tesserocr isn't installed
+    :param engine: One of OCR_ENGINES
+    :return:
+    """
+    global OCR_ENGINE
+    if engine not in OCR_ENGINES:
+        raise ValueError(f"Unknown OCR engine {engine!r}, expected one of {OCR_ENGINES}")
+    if engine == 'tesserocr':
+        try:
+            importlib.import_module('tesserocr')
+        except ImportError as e:
+            logger.warning(f"OCR engine tesserocr is not installed, keeping pytesseract: {e}")
+            engine = 'pytesseract'
+    OCR_ENGINE = engine
 
-        else:
-            # Convert to grayscale
-            img = img.convert('L')
 
-    custom_config = r'--oem 3 --psm 4'
-    # Perform OCR
-    data = pytesseract.image_to_data(img, output_type=pytesseract.Output.DICT, config=custom_config)
-    text = ''
+def _tesserocr_words(img: Image) -> tuple[list, list]:
+    """
+    OCR an image with this thread's tesseract API, with the same settings as the pytesseract config
+    :param img:
+    :return: The text and confidence of each word, like the text and conf of pytesseract.image_to_data
+    """
+    tesserocr = importlib.import_module('tesserocr')
+    api = getattr(_ocr_thread, 'api', None)
+    if api is None:
+        # loading the language model is the slow part, so each thread keeps its API for every image after
+        api = _ocr_thread.api = tesserocr.PyTessBaseAPI(psm=tesserocr.PSM.SINGLE_COLUMN, oem=tesserocr.OEM.DEFAULT)
+
+    try:
+        api.SetImage(img)
+        api.Recognize()
+        iterator = api.GetIterator()
+        if iterator is None:
+            return [], []
+
+        text_values, conf_values = [], []
+        for word in tesserocr.iterate_level(iterator, tesserocr.RIL.WORD):
+            text_values.append(word.GetUTF8Text(tesserocr.RIL.WORD) or '')
+            conf_values.append(word.Confidence(tesserocr.RIL.WORD))
+        return text_values, conf_values
+    finally:
+        api.Clear()
+
+
+def _triage_image(img: Image) -> str | None:
+    """
+    A cheap look at an image before OCRing it, to skip the many images on a page that hold no text
+    :param img: The opened image, the size check doesn't need it decoded
+    :return: Why the image isn't worth OCRing, 'too_small', 'empty' or 'photographic', or None to OCR it
+    """
+    width, height = img.size
+    if min(width, height) < TRIAGE_MIN_SIDE or width * height < TRIAGE_MIN_PIXELS:
+        return 'too_small'
+
+    try:
+        gray = _grayscale(img)
+    except OSError:
+        # let the OCR report the broken image
+        return None
+    if max(width, height) > TRIAGE_MAX_SIDE:
+        gray.thumbnail((TRIAGE_MAX_SIDE, TRIAGE_MAX_SIDE))
+    gray = np.asarray(gray)
+
+    edges = cv2.Canny(gray, *TRIAGE_CANNY_THRESHOLDS)
+    if np.count_nonzero(edges) < TRIAGE_MIN_EDGE_DENSITY * edges.size:
+        return 'empty'
+
+    gradient = np.abs(cv2.Sobel(gray, cv2.CV_16S, 1, 0)) + np.abs(cv2.Sobel(gray, cv2.CV_16S, 0, 1))
+    if np.count_nonzero(gradient < 40) < TRIAGE_MIN_FLAT_FRACTION * gradient.size:
+        return 'photographic'
+    return None
+
+
+def _binarize(img: Image, size: tuple) -> Image:
+    """
+    The preprocessing of enhance level 2 in one pipeline on a single greyscale array: greyscale, scale, contrast, blur
+    and threshold. The image is converted to greyscale before scaling, where there are fewer pixels, then the scaled
+    array is enhanced, blurred and thresholded in place, so it is the only buffer of the full size.
+    :param img:
+    :param size: The size to scale to
+    :return: A black and white image sharing the array's memory
+    """
+    if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+        img = Image.alpha_composite(Image.new('RGBA', img.size, 'white'), img.convert('RGBA'))
+    gray = np.asarray(img.convert('L'))
+    # the same contrast as ImageEnhance.Contrast(img).enhance(1.5), as a lookup table
+    mean = int(gray.mean() + 0.5)
+    contrast = np.clip(np.trunc(mean + 1.5 * (np.arange(256) - mean)), 0, 255).astype(np.uint8)
+
+    if (gray.shape[1], gray.shape[0]) != size:
+        interpolation = cv2.INTER_AREA if size[0] < gray.shape[1] else cv2.INTER_LANCZOS4
+        gray = cv2.resize(gray, size, interpolation=interpolation)
+    else:
+        gray = gray.copy()
+    cv2.LUT(gray, contrast, dst=gray)
+    cv2.GaussianBlur(gray, (3, 3), 0, dst=gray)
+    cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY, dst=gray)
+    return Image.fromarray(gray)
+
+
+def _grayscale(img: Image) -> Image:
+    """A greyscale copy of an image to measure, with any transparency shown over grey"""
+    if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+        # text may be dark or light on a transparent background, so show it on grey to see either
+        img = Image.alpha_composite(Image.new('RGBA', img.size, (128, 128, 128, 255)), img.convert('RGBA'))
+    return img.convert('L')
+
+
+def _ocr_scale(img: Image) -> float:
+    """
+    How much to scale an image before OCRing it, rather than a fixed factor that makes large scans enormous
+    :param img:
+    :return: The factor to multiply both sides by
+    """
+    text_height = _estimate_text_height(img)
+    if text_height is None:
+        scale = OCR_MAX_SCALE
+    else:
+        scale = min(max(OCR_TEXT_HEIGHT / text_height, OCR_MIN_SCALE), OCR_MAX_SCALE)
+    return min(scale, math.sqrt(OCR_MAX_PIXELS / (img.width * img.height)))
+
+
+def _estimate_text_height(img: Image) -> float | None:
+    """
+    Estimate the height of the text in an image from the median height of its glyph sized connected components
+    :param img:
+    :return: The height in pixels, or None if the image is too small or shows too few glyphs to tell
+    """
+    if min(img.width, img.height) < _TEXT_ESTIMATE_MIN_SIDE:
+        return None
+
+    try:
+        sample = _grayscale(img)
+    except OSError:
+        return None
+    reduction = math.ceil(math.sqrt(img.width * img.height / _TEXT_ESTIMATE_MAX_PIXELS))
+    if reduction > 1:
+        sample = sample.reduce(reduction)
+
+    gray = np.asarray(sample)
+    _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    if np.count_nonzero(binary) > binary.size / 2:
+        # the text is the minority colour, make it the foreground
+        binary = 255 - binary
+    _, _, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    heights = stats[1:, cv2.CC_STAT_HEIGHT]
+    widths = stats[1:, cv2.CC_STAT_WIDTH]
+    # leave out specks, and rules, boxes and pictures that are too tall or wide to be a letter
+    glyphs = heights[(heights >= 3) & (heights <= gray.shape[0] / 3) & (widths <= heights * 3)]
+    if len(glyphs) < 5:
+        return None
+    return float(np.median(glyphs)) * img.width / sample.width
+
+
+def _count_triage(reason: str | None) -> None:
+    """Count a triaged image, and the reason it was skipped if it was"""
+    with _triage_counts_lock:
+        _triage_counts['checked'] += 1
+        if reason:
+            _triage_counts[reason] += 1
+
+
+def get_triage_counts() -> dict:
+    """
+    How many images have been triaged in this process, and how many of them were skipped for each reason
+    :return: checked, too_small, empty and photographic counts
+    """
+    with _triage_counts_lock:
+        return {name: _triage_counts[name] for name in ('checked', 'too_small', 'empty', 'photographic')}
+
 
-    conf_values = data.get('conf', [])
-    text_values = data.get('text', [])
+def reset_triage_counts() -> None:
+    """Start counting triaged images from zero"""
+    with _triage_counts_lock:
+        _triage_counts.clear()
+
+
+def _confident_text(text_values: list, conf_values: list) -> str:
+    """The words tesseract is confident of, separated by spaces"""
+    text = ''
 
     for i in range(len(text_values)):
         conf_value = conf_values[i] if i < len(conf_values) else ''
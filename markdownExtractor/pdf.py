@@ -0,0 +1,583 @@
+import concurrent.futures
+import hashlib
+import io
+import itertools
+import logging
+import math
+import os
+import re
+import tempfile
+from collections import Counter
+from typing import Iterator
+
+from pdfminer.converter import HTMLConverter, PDFPageAggregator
+from pdfminer.image import ImageWriter
+from pdfminer.layout import LAParams, LTChar, LTContainer, LTFigure, LTImage, LTPage, LTTextBox, LTTextLine
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfparser import PDFParser
+
+from .html import md_from_html
+from .image import extract_image_md, init_ocr_worker
+
+logger = logging.getLogger(__name__)
+
+# 'html' renders the PDF to HTML with pdfminer and converts that like any other page, 'layout' walks pdfminer's layout
+# analysis and writes markdown directly, 'text' skips layout analysis and just follows the characters on each page
+PDF_ENGINES = ('html', 'layout', 'text')
+DEFAULT_PDF_ENGINE = 'html'
+
+# A text box whose characters are at least this much larger than the body text of its page is a heading, the first
+# ratio it reaches sets the level
+HEADING_SIZE_RATIOS = ((1.8, 1), (1.4, 2), (1.15, 3))
+MAX_HEADING_LENGTH = 200
+
+# Embedded images are only OCRed on pages with fewer characters of text than this, pages with a text layer of their
+# own are born digital and their images are mostly logos and decoration. None OCRs the images on every page.
+OCR_TEXT_THRESHOLD = 50
+
+# Splitting a PDF across processes costs a parse of the document per process, so don't give a process fewer pages
+MIN_PAGES_PER_WORKER = 4
+
+
+def extract_pdf(file_content: bytes, filepath: str = None, url: str = None, extract_images: bool = True,
+                strip_non_content: bool = True, enhance_image_level: int = 1, temp_directory: str = None,
+                **options) -> str:
+    """
+    Handler for application/pdf
+    :param file_content: The raw PDF
+    :param filepath: unused, the PDF is read from file_content
+    :param url:
+    :param extract_images: OCR the images embedded in the PDF
+    :param strip_non_content: Only used by the html engine
+    :param enhance_image_level:
+    :param temp_directory: unused, embedded images are exported to a directory of their own
+    :param options: pdf_engine, one of PDF_ENGINES, defaults to DEFAULT_PDF_ENGINE.
+      pdf_workers, the number of processes to split the pages of a long PDF across, defaults to 1.
+      pages, the zero-indexed page numbers to extract, and max_pages, the most pages to extract, default to all of them.
+      ocr_text_threshold, only OCR the images on pages with less text than this, defaults to OCR_TEXT_THRESHOLD.
+      html_parser, the tree builder the html engine parses its HTML with, see html.HTML_PARSERS.
+      image_workers, the number of images the html engine extracts at once, see html.IMAGE_WORKERS.
+    :return:
+    """
+    engine = options.get('pdf_engine') or DEFAULT_PDF_ENGINE
+    if engine not in PDF_ENGINES:
+        logger.error(f"Unknown PDF engine: {engine}")
+        return ''
+
+    workers = options.get('pdf_workers') or 1
+    pages = options.get('pages')
+    max_pages = options.get('max_pages')
+    ocr_text_threshold = options.get('ocr_text_threshold', OCR_TEXT_THRESHOLD)
+    html_options = _html_options(options)
+
+    if not extract_images:
+        return _convert(file_content, engine, url, None, extract_images, strip_non_content, enhance_image_level,
+                        workers, pages, max_pages, ocr_text_threshold, html_options)
+
+    # pdfminer can only export embedded images to a directory
+    with tempfile.TemporaryDirectory() as tempDirectory:
+        return _convert(file_content, engine, url, tempDirectory, extract_images, strip_non_content,
+                        enhance_image_level, workers, pages, max_pages, ocr_text_threshold, html_options)
+
+
+def iter_pdf_pages(file_content: bytes, url: str = None, extract_images: bool = True, strip_non_content: bool = True,
+                   enhance_image_level: int = 1, **options) -> Iterator[str]:
+    """
+    Page handler for application/pdf, converting a PDF one page at a time so that the caller can stop early and only
+    one page is held in memory at once
+    :param file_content: The raw PDF
+    :param url:
+    :param extract_images: OCR the images embedded in the PDF
+    :param strip_non_content: Only used by the html engine, where it is applied to each page on its own
+    :param enhance_image_level:
+    :param options: pdf_engine, pages, max_pages, ocr_text_threshold, html_parser and image_workers as for
+      extract_pdf
+    :return: The markdown of each page, empty for pages without any text
+    """
+    engine = options.get('pdf_engine') or DEFAULT_PDF_ENGINE
+    if engine not in PDF_ENGINES:
+        logger.error(f"Unknown PDF engine: {engine}")
+        return
+
+    pages = options.get('pages')
+    max_pages = options.get('max_pages')
+    ocr_text_threshold = options.get('ocr_text_threshold', OCR_TEXT_THRESHOLD)
+
+    with tempfile.TemporaryDirectory() as tempDirectory:
+        image_directory = tempDirectory if extract_images else None
+        if engine == 'html':
+            for html in _iter_html_pages(file_content, image_directory, pages, max_pages, ocr_text_threshold):
+                yield md_from_html(html, url=url, temp_directory=image_directory, extract_images=extract_images,
+                                   strip_non_content=strip_non_content, enhance_image_level=enhance_image_level,
+                                   **_html_options(options))
+        else:
+            for page in _iter_native_pages(file_content, engine, image_directory, extract_images,
+                                           enhance_image_level, pages, max_pages, ocr_text_threshold):
+                yield _tidy(page)
+
+
+def _convert(file_content: bytes, engine: str, url: str, temp_directory: str | None, extract_images: bool,
+             strip_non_content: bool, enhance_image_level: int, workers: int = 1, pages: list = None,
+             max_pages: int = None, ocr_text_threshold: int | None = OCR_TEXT_THRESHOLD,
+             html_options: dict = None) -> str:
+    """Convert a PDF to markdown with one of PDF_ENGINES, splitting it into page ranges if there are several workers"""
+    page_ranges = _page_ranges(file_content, workers, pages, max_pages) if workers > 1 else None
+
+    if engine == 'html':
+        if page_ranges is None:
+            return _pdf_to_md(file_content, url, temp_directory, extract_images, strip_non_content,
+                              enhance_image_level, pages, max_pages, ocr_text_threshold, html_options)
+
+        # render each range to HTML in parallel, then convert the whole document as usual
+        html = b''.join(_map_page_ranges(_render_html_range, page_ranges, file_content, temp_directory,
+                                         ocr_text_threshold))
+        return md_from_html(html, url=url, temp_directory=temp_directory, extract_images=extract_images,
+                            strip_non_content=strip_non_content, enhance_image_level=enhance_image_level,
+                            **(html_options or {}))
+
+    if page_ranges is None:
+        markdown_pages = _iter_native_pages(file_content, engine, temp_directory, extract_images, enhance_image_level,
+                                            pages, max_pages, ocr_text_threshold)
+    else:
+        markdown_pages = itertools.chain.from_iterable(_map_page_ranges(
+            _native_pages, page_ranges, file_content, engine, temp_directory, extract_images, enhance_image_level,
+            ocr_text_threshold))
+
+    return _join_pages(markdown_pages)
+
+
+def _iter_pdf_pages(file_content: bytes, pages: list = None, max_pages: int = None) -> Iterator[tuple]:
+    """
+    Walk the page tree of a PDF without loading pages that aren't wanted
+    :param file_content:
+    :param pages: Zero-indexed page numbers, all of them if None
+    :param max_pages: Stop after this many pages
+    :return: (zero-indexed page number, PDFPage) for each wanted page
+    """
+    wanted = set(pages) if pages is not None else None
+    document = PDFDocument(PDFParser(io.BytesIO(file_content)))
+    if not document.is_extractable:
+        logger.warning("The PDF does not allow text extraction, extracting anyway")
+
+    count = 0
+    for index, page in enumerate(PDFPage.create_pages(document)):
+        if wanted is not None and index not in wanted:
+            continue
+        yield index, page
+        count += 1
+        if (max_pages and count >= max_pages) or (wanted is not None and count >= len(wanted)):
+            break
+
+
+def _page_ranges(file_content: bytes, workers: int, pages: list = None, max_pages: int = None) -> list | None:
+    """
+    Split the pages of a PDF into one contiguous range per worker
+    :param file_content:
+    :param workers:
+    :param pages: Zero-indexed page numbers to split, all of them if None
+    :param max_pages: Only split the first this many of them
+    :return: A list of lists of zero-indexed page numbers, or None if the PDF isn't worth splitting
+    """
+    try:
+        page_numbers = [index for index, _ in _iter_pdf_pages(file_content, pages, max_pages)]
+    except Exception as e:
+        logger.warning(f"Could not count the pages of the PDF, extracting it in one go: {e}")
+        return None
+
+    workers = min(workers, len(page_numbers) // MIN_PAGES_PER_WORKER)
+    if workers <= 1:
+        return None
+
+    size = math.ceil(len(page_numbers) / workers)
+    return [page_numbers[start:start + size] for start in range(0, len(page_numbers), size)]
+
+
+def _map_page_ranges(function, page_ranges: list, file_content: bytes, *args) -> Iterator:
+    """
+    Call function(file_content, page_numbers, *args) for each page range on a process pool
+    :return: The results in page order
+    """
+    logger.debug(f"Extracting PDF in {len(page_ranges)} page ranges")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(page_ranges), initializer=init_ocr_worker,
+                                                initargs=(len(page_ranges),)) as executor:
+        futures = [executor.submit(function, file_content, page_numbers, *args) for page_numbers in page_ranges]
+        for future in futures:
+            yield future.result()
+
+
+def _render_html(file_content: bytes, page_numbers: list | None, image_directory: str | None,
+                 max_pages: int = None, ocr_text_threshold: int | None = OCR_TEXT_THRESHOLD,
+                 publish_directory: str = None) -> bytes:
+    """
+    Render pages to HTML the same way pdfminer's extract_text_to_fp does, keeping their page numbers
+    :param file_content:
+    :param page_numbers: Zero-indexed page numbers, all of them if None
+    :param image_directory: Where pdfminer writes embedded images, None to skip exporting them
+    :param max_pages: Stop after this many pages
+    :param ocr_text_threshold: Only export the images of pages with less text than this, None for every page
+    :param publish_directory: Move exported images here, see _DocumentImageWriter
+    :return:
+    """
+    html = io.BytesIO()
+    resource_manager = PDFResourceManager()
+    image_writer = _DocumentImageWriter(image_directory, publish_directory) if image_directory else None
+    device = _SelectiveImageHTMLConverter(resource_manager, html, codec='utf-8', imagewriter=image_writer,
+                                          ocr_text_threshold=ocr_text_threshold)
+    interpreter = PDFPageInterpreter(resource_manager, device)
+    for index, page in _iter_pdf_pages(file_content, page_numbers, max_pages):
+        device.pageno = index + 1
+        interpreter.process_page(page)
+    device.close()
+    return html.getvalue()
+
+
+def _render_html_range(file_content: bytes, page_numbers: list, image_directory: str | None,
+                       ocr_text_threshold: int | None) -> bytes:
+    """
+    Render a range of pages to HTML in a worker process, see _render_html. Images are exported to a directory of the
+    range's own, as pdfminer picks names that are only unique within one directory and one process, then moved into
+    image_directory named after their content for md_from_html to find.
+    """
+    if not image_directory:
+        return _render_html(file_content, page_numbers, None, ocr_text_threshold=ocr_text_threshold)
+
+    with tempfile.TemporaryDirectory(dir=image_directory) as range_directory:
+        return _render_html(file_content, page_numbers, range_directory, ocr_text_threshold=ocr_text_threshold,
+                            publish_directory=image_directory)
+
+
+def _iter_html_pages(file_content: bytes, image_directory: str | None, pages: list = None, max_pages: int = None,
+                     ocr_text_threshold: int | None = OCR_TEXT_THRESHOLD) -> Iterator[bytes]:
+    """
+    Render each page to an HTML document of its own
+    :param file_content:
+    :param image_directory: Where pdfminer writes embedded images, None to skip exporting them
+    :param pages: Zero-indexed page numbers, all of them if None
+    :param max_pages: Stop after this many pages
+    :param ocr_text_threshold: Only export the images of pages with less text than this, None for every page
+    :return:
+    """
+    resource_manager = PDFResourceManager()
+    image_writer = _DocumentImageWriter(image_directory) if image_directory else None
+    for index, page in _iter_pdf_pages(file_content, pages, max_pages):
+        html = io.BytesIO()
+        device = _SelectiveImageHTMLConverter(resource_manager, html, codec='utf-8', pageno=index + 1,
+                                              imagewriter=image_writer, ocr_text_threshold=ocr_text_threshold)
+        PDFPageInterpreter(resource_manager, device).process_page(page)
+        device.close()
+        yield html.getvalue()
+
+
+def _native_pages(file_content: bytes, page_numbers: list, engine: str, image_directory: str | None,
+                  extract_images: bool, enhance_image_level: int, ocr_text_threshold: int | None) -> list:
+    """
+    The markdown of each page in a range, see _iter_native_pages. The range's images are exported to a directory of
+    its own, so workers never race each other for image names, and deleted once they have been read.
+    """
+    if not image_directory:
+        return list(_iter_native_pages(file_content, engine, None, extract_images, enhance_image_level,
+                                       page_numbers=page_numbers, ocr_text_threshold=ocr_text_threshold))
+
+    with tempfile.TemporaryDirectory(dir=image_directory) as range_directory:
+        return list(_iter_native_pages(file_content, engine, range_directory, extract_images, enhance_image_level,
+                                       page_numbers=page_numbers, ocr_text_threshold=ocr_text_threshold))
+
+
+def _pdf_to_md(file_content: bytes, url: str, temp_directory: str | None, extract_images: bool,
+               strip_non_content: bool, enhance_image_level: int, pages: list = None, max_pages: int = None,
+               ocr_text_threshold: int | None = OCR_TEXT_THRESHOLD, html_options: dict = None) -> str:
+    """
+    Convert a PDF to HTML in memory, then to markdown
+    :param file_content:
+    :param url:
+    :param temp_directory: Where pdfminer writes embedded images, None to skip exporting them
+    :param extract_images:
+    :param strip_non_content:
+    :param enhance_image_level:
+    :param pages: Zero-indexed page numbers, all of them if None
+    :param max_pages: Stop after this many pages
+    :param ocr_text_threshold: Only export the images of pages with less text than this, None for every page
+    :param html_options: Further keyword arguments for md_from_html, from _html_options
+    :return:
+    """
+    html = _render_html(file_content, pages, temp_directory, max_pages, ocr_text_threshold)
+
+    return md_from_html(html, url=url, temp_directory=temp_directory, extract_images=extract_images,
+                        strip_non_content=strip_non_content, enhance_image_level=enhance_image_level,
+                        **(html_options or {}))
+
+
+def _html_options(options: dict) -> dict:
+    """The options of extract_pdf that the html engine passes on to md_from_html"""
+    # the images of a PDF are its content, scanned pages among them, so they are always OCRed
+    return {'parser': options.get('html_parser'), 'image_workers': options.get('image_workers'), 'triage': False}
+
+
+def _tidy(text: str) -> str:
+    """Tidy whitespace the same way md_from_html does"""
+    text = re.sub(r'\n{3,}', '\n\n', text)
+    text = re.sub(r' {3,}', '  ', text)
+    return text.strip()
+
+
+def _join_pages(pages: Iterator[str]) -> str:
+    """Join the markdown of each page"""
+    return _tidy('\n\n'.join(page for page in pages if page))
+
+
+def _iter_native_pages(file_content: bytes, engine: str, image_directory: str | None, extract_images: bool,
+                       enhance_image_level: int, page_numbers: list = None, max_pages: int = None,
+                       ocr_text_threshold: int | None = OCR_TEXT_THRESHOLD) -> Iterator[str]:
+    """
+    Convert a PDF to markdown page by page without the HTML round trip
+    :param file_content:
+    :param engine: 'layout' or 'text'
+    :param image_directory: Where to export embedded images to OCR them, None to skip them
+    :param extract_images:
+    :param enhance_image_level:
+    :param page_numbers: Zero-indexed page numbers to convert, all of them if None
+    :param max_pages: Stop after this many pages
+    :param ocr_text_threshold: Only OCR the images of pages with less text than this, None for every page
+    :return: The markdown of each page
+    """
+    # without LAParams pdfminer skips layout analysis and the page is a flat list of characters and figures,
+    # all_texts lays out the text drawn inside figures (form XObjects) as well
+    laparams = LAParams(all_texts=True) if engine == 'layout' else None
+    image_writer = _DocumentImageWriter(image_directory) if extract_images and image_directory else None
+
+    for page in _iter_layouts(file_content, laparams, page_numbers, max_pages):
+        page_image_writer = image_writer if _needs_ocr(page, ocr_text_threshold) else None
+        if engine == 'layout':
+            yield _layout_page_to_md(page, page_image_writer, enhance_image_level)
+        else:
+            yield _text_page_to_md(page, page_image_writer, enhance_image_level)
+
+
+def _iter_layouts(file_content: bytes, laparams: LAParams | None, page_numbers: list = None,
+                  max_pages: int = None) -> Iterator[LTPage]:
+    """
+    Lay out each page of a PDF, like pdfminer's extract_pages but without forcing layout analysis on
+    :param file_content:
+    :param laparams: None to skip layout analysis
+    :param page_numbers: Zero-indexed page numbers to lay out, all of them if None
+    :param max_pages: Stop after this many pages
+    :return:
+    """
+    resource_manager = PDFResourceManager()
+    device = PDFPageAggregator(resource_manager, laparams=laparams)
+    interpreter = PDFPageInterpreter(resource_manager, device)
+    for _, page in _iter_pdf_pages(file_content, page_numbers, max_pages):
+        interpreter.process_page(page)
+        yield device.get_result()
+
+
+def _layout_page_to_md(page: LTPage, image_writer: ImageWriter | None, enhance_image_level: int) -> str:
+    """
+    Markdown for a page that went through layout analysis: a paragraph per text box, headings picked out by font size
+    :param page:
+    :param image_writer: Exports embedded images to OCR, None to skip them
+    :param enhance_image_level:
+    :return:
+    """
+    body_size = _body_font_size(page)
+    blocks = []
+    for element in _iter_flattened(page):
+        if isinstance(element, LTTextBox):
+            blocks.append(_text_box_to_md(element, body_size))
+        elif image_writer is not None and isinstance(element, LTImage):
+            blocks.extend(_images_to_md(element, image_writer, enhance_image_level))
+
+    return '\n\n'.join(block for block in blocks if block)
+
+
+def _body_font_size(page: LTPage) -> float | None:
+    """The most common character size on the page, taken to be the size of the body text"""
+    sizes = Counter(round(char.size) for box in _iter_flattened(page) if isinstance(box, LTTextBox)
+                    for line in box if isinstance(line, LTTextLine)
+                    for char in line if isinstance(char, LTChar))
+    if not sizes:
+        return None
+    return sizes.most_common(1)[0][0]
+
+
+def _text_box_to_md(box: LTTextBox, body_size: float | None) -> str:
+    """
+    Markdown for a text box, as a heading if its text is noticeably larger than the body text
+    :param box:
+    :param body_size:
+    :return:
+    """
+    lines = [line.get_text().strip() for line in box if isinstance(line, LTTextLine)]
+    text = '\n'.join(line for line in lines if line)
+    if not text or not body_size or len(text) > MAX_HEADING_LENGTH:
+        return text
+
+    sizes = [char.size for line in box if isinstance(line, LTTextLine) for char in line if isinstance(char, LTChar)]
+    if not sizes:
+        return text
+
+    ratio = sum(sizes) / len(sizes) / body_size
+    for min_ratio, level in HEADING_SIZE_RATIOS:
+        if ratio >= min_ratio:
+            return f"{'#' * level} {' '.join(line for line in lines if line)}"
+
+    return text
+
+
+def _text_page_to_md(page: LTPage, image_writer: ImageWriter | None, enhance_image_level: int) -> str:
+    """
+    Markdown for a page without layout analysis. Characters are taken in the order they are drawn, starting a new line
+    when the baseline moves and a new paragraph when it jumps by more than a line.
+    :param page:
+    :param image_writer: Exports embedded images to OCR, None to skip them
+    :param enhance_image_level:
+    :return:
+    """
+    parts = []
+    previous = None
+    for element in _iter_flattened(page):
+        if isinstance(element, LTChar):
+            if previous is not None:
+                parts.append(_char_separator(previous, element))
+            parts.append(element.get_text())
+            previous = element
+        elif image_writer is not None and isinstance(element, LTImage):
+            for image_md in _images_to_md(element, image_writer, enhance_image_level):
+                parts.append(f'\n\n{image_md}\n\n')
+            previous = None
+
+    text = ''.join(parts)
+    return '\n'.join(line.strip() for line in text.split('\n')).strip()
+
+
+def _char_separator(previous: LTChar, char: LTChar) -> str:
+    """What goes between two consecutive characters: nothing, a space, a new line or a new paragraph"""
+    height = max(previous.height, char.height, 1)
+    rise = abs(char.y0 - previous.y0)
+    if rise > height * 1.5:
+        return '\n\n'
+    if rise > height * 0.5:
+        return '\n'
+    if char.x0 - previous.x1 > char.width * 0.25 and not previous.get_text().isspace() \
+            and not char.get_text().isspace():
+        return ' '
+    return ''
+
+
+def _iter_flattened(container) -> Iterator:
+    """The elements of a page in drawing order, with the contents of figures (form XObjects) in place of the figures"""
+    for element in container:
+        if isinstance(element, LTFigure):
+            yield from _iter_flattened(element)
+        else:
+            yield element
+
+
+def _iter_images(element) -> Iterator[LTImage]:
+    """Every image in a figure, figures can be nested"""
+    if isinstance(element, LTImage):
+        yield element
+    elif isinstance(element, LTFigure):
+        for child in element:
+            yield from _iter_images(child)
+
+
+def _images_to_md(element, image_writer: '_DocumentImageWriter', enhance_image_level: int) -> list:
+    """
+    Export the images in a figure and extract their text, an image that was already OCRed reuses its markdown
+    :param element: An LTFigure or LTImage
+    :param image_writer:
+    :param enhance_image_level:
+    :return: The markdown for each image that had any text
+    """
+    blocks = []
+    for image in _iter_images(element):
+        try:
+            filename = image_writer.export_image(image)
+        except Exception as e:
+            logger.warning(f"Could not export image {image.name}: {e}")
+            continue
+
+        if filename not in image_writer.markdown:
+            image_writer.markdown[filename] = extract_image_md(filename, os.path.join(image_writer.outdir, filename),
+                                                               enhance_level=enhance_image_level)
+        image_md = image_writer.markdown[filename]
+        if image_md:
+            blocks.append(image_md)
+
+    return blocks
+
+
+def _text_layer_length(page: LTPage, limit: int) -> int:
+    """
+    Count the characters of text on a page, other than whitespace
+    :param page:
+    :param limit: Stop counting once there are this many
+    :return:
+    """
+    count = 0
+    stack = [page]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, LTChar):
+            if not item.get_text().isspace():
+                count += 1
+                if count >= limit:
+                    break
+        elif isinstance(item, LTContainer):
+            stack.extend(item)
+    return count
+
+
+def _needs_ocr(page: LTPage, ocr_text_threshold: int | None) -> bool:
+    """Whether the images on a page should be OCRed, see OCR_TEXT_THRESHOLD"""
+    if ocr_text_threshold is None:
+        return True
+    return _text_layer_length(page, ocr_text_threshold) < ocr_text_threshold
+
+
+class _DocumentImageWriter(ImageWriter):
+    """
+    Exports each distinct image of a document once. An image that repeats, like a letterhead logo on every page, gets
+    the name it was first exported with, so its text is only extracted once.
+    If publish_directory is given each image is moved there once exported, named after its content, so several
+    processes can publish to the same directory without clashing.
+    """
+
+    def __init__(self, outdir: str, publish_directory: str = None):
+        super().__init__(outdir)
+        self.publish_directory = publish_directory
+        # digest of the image data -> name it was exported as
+        self._names = {}
+        # name -> markdown extracted from it, filled in by whoever OCRs the image
+        self.markdown = {}
+
+    def export_image(self, image: LTImage) -> str:
+        digest = hashlib.md5(image.stream.get_rawdata() or b'')
+        digest.update(repr((image.srcsize, image.bits, image.colorspace)).encode('utf-8'))
+        digest = digest.hexdigest()
+
+        if digest not in self._names:
+            name = super().export_image(image)
+            if self.publish_directory:
+                published = digest + os.path.splitext(name)[1]
+                os.replace(os.path.join(self.outdir, name), os.path.join(self.publish_directory, published))
+                name = published
+            self._names[digest] = name
+        return self._names[digest]
+
+
+class _SelectiveImageHTMLConverter(HTMLConverter):
+    """An HTMLConverter that only exports the images of pages that need OCR, see OCR_TEXT_THRESHOLD"""
+
+    def __init__(self, *args, ocr_text_threshold: int | None = OCR_TEXT_THRESHOLD, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ocr_text_threshold = ocr_text_threshold
+        self._imagewriter = self.imagewriter
+
+    def receive_layout(self, ltpage: LTPage) -> None:
+        # without an image writer pdfminer leaves the images out of the HTML
+        self.imagewriter = self._imagewriter if _needs_ocr(ltpage, self.ocr_text_threshold) else None
+        super().receive_layout(ltpage)
@@ -1,27 +1,227 @@
+import concurrent.futures
+import contextlib
+import io
+import itertools
+import logging
+import math
+import zipfile
+from typing import Iterator
+from xml.etree import ElementTree
+
 from pptx import Presentation
+from pptx.shapes.group import GroupShape
+from pptx.shapes.picture import Picture
 from pptx.util import Pt
 
+from .image import extract_image_md, init_ocr_worker
+
+logger = logging.getLogger(__name__)
+
+P = '{http://schemas.openxmlformats.org/presentationml/2006/main}'
+
+# Splitting a deck across processes costs a load of the deck per process, so don't give a process fewer slides
+MIN_SLIDES_PER_WORKER = 10
+
+
+def extract_pptx(file_content: bytes, filepath: str = None, url: str = None, extract_images: bool = True,
+                 strip_non_content: bool = True, enhance_image_level: int = 1, temp_directory: str = None,
+                 **options) -> str:
+    """
+    Handler for presentations (.pptx)
+    :param file_content: The raw presentation
+    :param filepath: unused, the presentation is read from file_content
+    :param extract_images: OCR the pictures on the slides
+    :param enhance_image_level:
+    :param options: pptx_workers, the number of processes to split the slides of a large deck across, defaults to 1.
+      ocr_workers, the number of pictures to OCR at once.
+    :return:
+    """
+    workers = options.get('pptx_workers') or 1
+    slide_ranges = _slide_ranges(file_content, workers) if workers > 1 else None
+    if slide_ranges is None:
+        return extract_pptx_md(io.BytesIO(file_content), extract_images=extract_images,
+                               enhance_image_level=enhance_image_level, ocr_workers=options.get('ocr_workers'))
+
+    logger.debug(f"Extracting presentation in {len(slide_ranges)} slide ranges")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(slide_ranges), initializer=init_ocr_worker,
+                                                initargs=(len(slide_ranges),)) as executor:
+        futures = [executor.submit(_slide_range_parts, file_content, slide_numbers, extract_images,
+                                   enhance_image_level, options.get('ocr_workers')) for slide_numbers in slide_ranges]
+        return "\n".join(itertools.chain.from_iterable(future.result() for future in futures))
+
+
+def iter_pptx_slides(file_content: bytes, url: str = None, extract_images: bool = True,
+                     strip_non_content: bool = True, enhance_image_level: int = 1, **options) -> Iterator[str]:
+    """
+    Page handler for presentations, converting a deck one slide at a time. The pictures of the next slide are OCRed
+    while the caller handles the current one.
+    :param file_content: The raw presentation
+    :param url:
+    :param extract_images: OCR the pictures on the slides
+    :param strip_non_content:
+    :param enhance_image_level:
+    :param options: ocr_workers as for extract_pptx. pages, zero-indexed slide numbers to extract, and max_pages, the
+      number of slides to stop after, as for PDFs.
+    :return: The markdown of each slide
+    """
+    slides = Presentation(io.BytesIO(file_content)).slides
+    if options.get('pages') is not None:
+        pages = set(options['pages'])
+        slides = [slide for index, slide in enumerate(slides) if index in pages]
+    if options.get('max_pages') is not None:
+        slides = itertools.islice(slides, options['max_pages'])
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=options.get('ocr_workers')) \
+        if extract_images else None
 
-def extract_pptx_md(file_path):
+    with executor or contextlib.nullcontext():
+        pending = None
+        for parts in _iter_slide_parts(slides, executor, enhance_image_level, {}):
+            if pending is not None:
+                yield "\n".join(_resolve(pending))
+            pending = parts
+        if pending is not None:
+            yield "\n".join(_resolve(pending))
+
+
+def extract_pptx_md(file_path, extract_images: bool = False, enhance_image_level: int = 1, ocr_workers: int = None):
+    """
+    Convert a presentation to markdown
+    :param file_path: A path or a file object
+    :param extract_images: OCR the pictures on the slides
+    :param enhance_image_level:
+    :param ocr_workers: Maximum number of pictures to OCR at once
+    :return:
+    """
     presentation = Presentation(file_path)
-    result = []
+    return "\n".join(_slides_parts(presentation.slides, extract_images, enhance_image_level, ocr_workers))
+
+
+def _slides_parts(slides, extract_images: bool, enhance_image_level: int, ocr_workers: int = None) -> list:
+    """The text of every run and picture on the slides, the pictures are OCRed on a thread pool"""
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=ocr_workers) if extract_images else None
+    with executor or contextlib.nullcontext():
+        parts = list(itertools.chain.from_iterable(_iter_slide_parts(slides, executor, enhance_image_level, {})))
+        return _resolve(parts)
+
+
+def _slide_range_parts(file_content: bytes, slide_numbers: list, extract_images: bool, enhance_image_level: int,
+                       ocr_workers: int = None) -> list:
+    """Load a deck and convert a range of its slides, run on a worker process"""
+    slides = Presentation(io.BytesIO(file_content)).slides
+    return _slides_parts([slides[index] for index in slide_numbers], extract_images, enhance_image_level,
+                         ocr_workers)
+
 
-    for slide in presentation.slides:
-        for shape in slide.shapes:
-            if shape.has_text_frame:
-                for paragraph in shape.text_frame.paragraphs:
-                    for run in paragraph.runs:
-                        text = run.text
-                        if run.font.bold:
-                            text = f"**{text}**"  # bold text
-                        if run.font.italic:
-                            text = f"*{text}*"  # italic text
-                        if run.font.underline:
-                            text = f"_{text}_"  # underline text
-                        if run.hyperlink and run.hyperlink.address:
-                            text = f"[{text}]({run.hyperlink.address})"  # hyperlink
-                        if run.font.size and run.font.size >= Pt(24):
-                            text = f"# {text}"  # heading
-                        result.append(text)
-
-    return "\n".join(result)
+def _slide_ranges(file_content: bytes, workers: int) -> list | None:
+    """
+    Split the slides of a deck into one contiguous range per worker
+    :param file_content:
+    :param workers:
+    :return: A list of lists of zero-indexed slide numbers, or None if the deck isn't worth splitting
+    """
+    # the slide list of the presentation part, rather than loading every slide of the deck just to count them
+    try:
+        with zipfile.ZipFile(io.BytesIO(file_content)) as pptx, pptx.open('ppt/presentation.xml') as presentation:
+            slide_count = sum(1 for _, element in ElementTree.iterparse(presentation) if element.tag == P + 'sldId')
+    except (KeyError, zipfile.BadZipFile, ElementTree.ParseError) as e:
+        logger.warning(f"Could not count the slides of the presentation, extracting it in one go: {e}")
+        return None
+
+    workers = min(workers, slide_count // MIN_SLIDES_PER_WORKER)
+    if workers <= 1:
+        return None
+
+    size = math.ceil(slide_count / workers)
+    return [list(range(start, min(start + size, slide_count))) for start in range(0, slide_count, size)]
+
+
+def _resolve(parts: list) -> list:
+    """Wait for the OCR of any pictures among the parts of a slide, dropping pictures without text"""
+    resolved = []
+    for part in parts:
+        if isinstance(part, concurrent.futures.Future):
+            part = part.result()
+            if not part:
+                continue
+        resolved.append(part)
+    return resolved
+
+
+def _iter_slide_parts(slides, executor: concurrent.futures.Executor | None, enhance_image_level: int,
+                      ocr: dict) -> Iterator[list]:
+    """
+    The text of each run on each slide, in order, with a future for the OCR of each picture
+    :param slides:
+    :param executor: Where to OCR the pictures, None to skip them
+    :param enhance_image_level:
+    :param ocr: Image hash -> future, so a picture used on many slides is only OCRed once
+    :return: A list of strings and futures for each slide
+    """
+    for slide in slides:
+        parts = []
+        for shape in _iter_shapes(slide.shapes, executor is not None):
+            if isinstance(shape, Picture):
+                parts.append(_submit_picture(shape, executor, enhance_image_level, ocr))
+            elif shape.has_text_frame:
+                parts.extend(_text_frame_parts(shape.text_frame))
+        yield parts
+
+
+def _iter_shapes(shapes, include_pictures: bool):
+    """The shapes of a slide, with the pictures inside groups if we are extracting pictures"""
+    for shape in shapes:
+        if include_pictures and isinstance(shape, GroupShape):
+            yield from (child for child in _iter_shapes(shape.shapes, include_pictures)
+                        if isinstance(child, Picture))
+        elif include_pictures or not isinstance(shape, Picture):
+            yield shape
+
+
+def _submit_picture(picture: Picture, executor: concurrent.futures.Executor, enhance_image_level: int,
+                    ocr: dict) -> concurrent.futures.Future:
+    """Start OCRing a picture, or return the future for the same image if it was already started"""
+    try:
+        image = picture.image
+    except Exception as e:
+        # linked rather than embedded pictures have no image to read
+        logger.debug(f"Skipping picture without an embedded image: {e}")
+        future = concurrent.futures.Future()
+        future.set_result('')
+        return future
+
+    if image.sha1 not in ocr:
+        # the non-visual properties are the first child of the shape, whatever kind of shape it is
+        properties = picture.element.xpath('./*[1]/p:cNvPr')
+        alt_text = properties[0].get('descr', '') if properties else ''
+        ocr[image.sha1] = executor.submit(_picture_to_md, image.blob, image.filename or f"image.{image.ext}",
+                                          alt_text, enhance_image_level)
+    return ocr[image.sha1]
+
+
+def _picture_to_md(image_data: bytes, name: str, alt_text: str, enhance_image_level: int) -> str:
+    """Extract the text of a picture, a picture that can't be read is left out"""
+    try:
+        return extract_image_md(name, None, alt_text, enhance_level=enhance_image_level, image_data=image_data)
+    except Exception as e:
+        logger.error(f"Failed to extract text from {name}: {e}")
+        return ''
+
+
+def _text_frame_parts(text_frame) -> list:
+    """The markdown of each run in a text frame"""
+    result = []
+    for paragraph in text_frame.paragraphs:
+        for run in paragraph.runs:
+            text = run.text
+            if run.font.bold:
+                text = f"**{text}**"  # bold text
+            if run.font.italic:
+                text = f"*{text}*"  # italic text
+            if run.font.underline:
+                text = f"_{text}_"  # underline text
+            if run.hyperlink and run.hyperlink.address:
+                text = f"[{text}]({run.hyperlink.address})"  # hyperlink
+            if run.font.size and run.font.size >= Pt(24):
+                text = f"# {text}"  # heading
+            result.append(text)
+    return result
@@ -0,0 +1,109 @@
+import importlib
+import logging
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+DOCX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+PPTX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.presentationml.presentation'
+
+# mimetype -> handler, either a callable or a "module:function" string that is only imported on first use.
+# Keys ending in '/' match every subtype of that major type.
+# Handlers are called as handler(file_content, filepath=None, url=None, extract_images=True, strip_non_content=True,
+# enhance_image_level=1, temp_directory=None, **options) and return markdown, or an empty string on failure.
+HANDLERS: dict[str, Callable | str] = {
+    'text/html': 'markdownExtractor.html:extract_html',
+    'application/pdf': 'markdownExtractor.pdf:extract_pdf',
+    DOCX_MIMETYPE: 'markdownExtractor.docx:extract_docx',
+    PPTX_MIMETYPE: 'markdownExtractor.powerpoint:extract_pptx',
+    'image/': 'markdownExtractor.image:extract_image',
+}
+
+# mimetype -> page handler, for formats that can be converted a page (or slide) at a time. Page handlers take the same
+# arguments as handlers and return an iterator of markdown, one item per page.
+PAGE_HANDLERS: dict[str, Callable | str] = {
+    'application/pdf': 'markdownExtractor.pdf:iter_pdf_pages',
+    PPTX_MIMETYPE: 'markdownExtractor.powerpoint:iter_pptx_slides',
+}
+
+
+def register_handler(filemime: str, handler: Callable | str) -> None:
+    """
+    Register a handler for a mimetype, replacing any existing one
+    :param filemime: A mimetype, or a major type ending in '/' to handle every subtype
+    :param handler: A callable, or a "module:function" string to import on first use
+    :return:
+    """
+    HANDLERS[filemime] = handler
+
+
+def register_page_handler(filemime: str, handler: Callable | str) -> None:
+    """
+    Register a page handler for a mimetype, replacing any existing one
+    :param filemime: A mimetype, or a major type ending in '/' to handle every subtype
+    :param handler: A callable, or a "module:function" string to import on first use
+    :return:
+    """
+    PAGE_HANDLERS[filemime] = handler
+
+
+def _handler_key(filemime: str, handlers: dict = None) -> str | None:
+    """Find the registry key for a mimetype, preferring an exact match over the major type"""
+    if handlers is None:
+        handlers = HANDLERS
+
+    if filemime in handlers:
+        return filemime
+
+    if filemime and '/' in filemime:
+        major_type = filemime.split('/', 1)[0] + '/'
+        if major_type in handlers:
+            return major_type
+
+    return None
+
+
+def _load_handler(filemime: str, handlers: dict) -> Callable | None:
+    """Get a handler from one of the registries, importing it if this is the first use"""
+    key = _handler_key(filemime, handlers)
+    if key is None:
+        return None
+
+    handler = handlers[key]
+    if isinstance(handler, str):
+        module_name, function_name = handler.split(':', 1)
+        logger.debug(f"Loading handler for {key} from {module_name}")
+        handler = getattr(importlib.import_module(module_name), function_name)
+        handlers[key] = handler
+
+    return handler
+
+
+def get_handler(filemime: str) -> Callable | None:
+    """
+    Get the handler for a mimetype, importing it if this is the first use
+    :param filemime: The normalized mimetype
+    :return: The handler, or None if the mimetype is unsupported
+    """
+    return _load_handler(filemime, HANDLERS)
+
+
+def get_page_handler(filemime: str) -> Callable | None:
+    """
+    Get the page handler for a mimetype, importing it if this is the first use
+    :param filemime: The normalized mimetype
+    :return: The page handler, or None if the mimetype can only be converted whole
+    """
+    return _load_handler(filemime, PAGE_HANDLERS)
+
+
+def preload_handlers(*filemimes: str) -> None:
+    """
+    Import handlers up front, so that the import cost is paid at startup instead of on the first document
+    :param filemimes: The mimetypes to load, all registered handlers if none are given
+    :return:
+    """
+    for filemime in filemimes or list(HANDLERS):
+        if get_handler(filemime) is None:
+            logger.warning(f"No handler registered for {filemime}")
+
@@ -0,0 +1,127 @@
+import io
+import logging
+import re
+import zipfile
+
+from .registry import DOCX_MIMETYPE, PPTX_MIMETYPE
+
+logger = logging.getLogger(__name__)
+
+# How far into a document we look for a signature
+SNIFF_BYTES = 1024
+
+# Fixed byte signatures at the start of the document
+_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'II*\x00', 'image/tiff'),
+    (b'MM\x00*', 'image/tiff'),
+]
+
+# Mimetypes servers use when they don't know (or won't say) what they are sending
+GENERIC_MIMETYPES = {
+    'application/octet-stream',
+    'binary/octet-stream',
+    'application/binary',
+    'application/download',
+    'application/force-download',
+    'application/x-download',
+    'application/unknown',
+}
+
+_HTML_PATTERN = re.compile(rb'^\s*(<!--.*?-->\s*)*<(!doctype\s+html|html|head|body)[\s>]', re.IGNORECASE | re.DOTALL)
+_SVG_PATTERN = re.compile(rb'^\s*(<\?xml[^>]*>\s*)?(<!--.*?-->\s*)*(<!doctype\s+svg[^>]*>\s*)?<svg[\s>]',
+                          re.IGNORECASE | re.DOTALL)
+
+
+def _sniff_zip(data: bytes) -> str:
+    """Office documents are zip files, tell them apart by the parts they contain"""
+    try:
+        names = zipfile.ZipFile(io.BytesIO(data)).namelist()
+    except zipfile.BadZipFile:
+        return 'application/zip'
+
+    if any(name.startswith('word/') for name in names):
+        return DOCX_MIMETYPE
+    if any(name.startswith('ppt/') for name in names):
+        return PPTX_MIMETYPE
+    return 'application/zip'
+
+
+def _head(data: bytes | str) -> bytes:
+    """The start of the document as bytes, markup is sometimes passed around already decoded"""
+    head = data[:SNIFF_BYTES]
+    if isinstance(head, str):
+        head = head.encode('utf-8', errors='ignore')
+    return head
+
+
+def sniff_mimetype(data: bytes | str) -> str | None:
+    """
+    Identify a document from the signature in its first bytes
+    :param data: The document, or at least its start (zip based formats need the whole document)
+    :return: The mimetype if there is an unambiguous binary signature (or SVG markup), otherwise None
+    """
+    head = _head(data)
+
+    for signature, filemime in _SIGNATURES:
+        if head.startswith(signature):
+            return filemime
+
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        return 'image/webp'
+
+    if head.startswith(b'BM') and head[6:10] == b'\x00\x00\x00\x00':
+        # the reserved bytes of a bitmap header are always zero
+        return 'image/bmp'
+
+    if head.lstrip(b'\xef\xbb\xbf').lstrip().startswith(b'%PDF-'):
+        return 'application/pdf'
+
+    if head.startswith(b'PK\x03\x04'):
+        return _sniff_zip(data)
+
+    if _SVG_PATTERN.match(head.lstrip(b'\xef\xbb\xbf')):
+        return 'image/svg+xml'
+
+    return None
+
+
+def looks_like_html(data: bytes | str) -> bool:
+    """
+    Weak check for HTML markup at the start of a document
+    :param data:
+    :return:
+    """
+    return bool(_HTML_PATTERN.match(_head(data).lstrip(b'\xef\xbb\xbf')))
+
+
+def resolve_mimetype(data: bytes | str, filemime: str = None) -> str | None:
+    """
+    Choose the mimetype to extract a document as. A binary signature always wins over the declared type, HTML markup
+    is only trusted when nothing more specific was declared.
+    :param data: The document
+    :param filemime: The declared mimetype (from a header or the file extension), normalized
+    :return: The mimetype, or None if it could not be determined
+    """
+    sniffed = sniff_mimetype(data)
+
+    if sniffed == 'application/zip' and filemime in (DOCX_MIMETYPE, PPTX_MIMETYPE):
+        # a damaged office document, let the handler have a go at it
+        return filemime
+
+    if sniffed:
+        if filemime and sniffed != filemime:
+            logger.debug(f"Content looks like {sniffed}, not the declared {filemime}")
+        return sniffed
+
+    if not filemime or filemime in GENERIC_MIMETYPES:
+        if looks_like_html(data):
+            return 'text/html'
+        # PDF readers accept junk before the header, but an HTML or text page may just mention it
+        if b'%PDF-' in _head(data):
+            return 'application/pdf'
+
+    return filemime